@@ -0,0 +1,208 @@
+"""Inference benchmarks on randomly initialized LLaMA models, no checkpoint needed.
+
+Sweeps synthetic model sizes, batch sizes, prompt lengths and dtypes, and measures for each combination the time to
+first token (prefill), the per-token decode latency (mean, p50, p99), decode throughput and the peak resident memory.
+Every combination runs in a fresh process, so its peak memory is its own and not that of the cases before it. Results
+are written as JSON so runs can be compared across commits::
+
+    python benchmark.py --configs '["nano", "small"]' --dtypes '["float32", "bfloat16"]' --output results.json
+"""
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import torch
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from generate import decode_one_token, prefill_batch
+from model import LLaMA, LLaMAConfig
+from utils import configure_cpu_threads, pick_device
+
+# tiny to mid sized models, small enough to run on a laptop CPU
+synthetic_configs = {
+    "nano": dict(n_layer=2, n_head=4, n_embd=128, vocab_size=4096),
+    "small": dict(n_layer=6, n_head=8, n_embd=512),
+    "mid": dict(n_layer=12, n_head=12, n_embd=768),
+}
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def peak_rss_mb() -> float:
+    """The peak resident set size of this process over its whole lifetime, in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def build_model(name: str, device: torch.device, dtype: torch.dtype, seed: int = 1234) -> LLaMA:
+    """A randomly initialized model of ``synthetic_configs[name]``, identical for the same seed."""
+    torch.manual_seed(seed)
+    with torch.device(device):
+        model = LLaMA(LLaMAConfig(**synthetic_configs[name]))
+    return model.to(dtype=dtype).eval()
+
+
+@torch.no_grad()
+def run_case(
+    model: LLaMA, batch_size: int, prompt_length: int, new_tokens: int, device: torch.device, seed: int = 1234
+) -> Dict[str, float]:
+    """Times one prefill of ``batch_size`` random prompts and ``new_tokens - 1`` decode steps after it."""
+    generator = torch.Generator().manual_seed(seed)
+    prompts = [
+        torch.randint(model.config.vocab_size, (prompt_length,), generator=generator, dtype=torch.int).to(device)
+        for _ in range(batch_size)
+    ]
+    model.setup_caches(max_batch_size=batch_size, max_seq_length=prompt_length + new_tokens)
+
+    _sync(device)
+    t0 = time.perf_counter()
+    token = prefill_batch(model, prompts, [0] * batch_size, temperature=0.8, top_k=200)
+    _sync(device)
+    ttft = time.perf_counter() - t0
+
+    input_pos = torch.full((batch_size, 1), prompt_length, device=device)
+    latencies = []
+    for _ in range(new_tokens - 1):
+        t0 = time.perf_counter()
+        token = decode_one_token(model, input_pos, token.view(batch_size, 1), temperature=0.8, top_k=200)
+        _sync(device)
+        latencies.append(time.perf_counter() - t0)
+        input_pos += 1
+    model.reset_cache()
+
+    mean = statistics.mean(latencies)
+    return dict(
+        ttft_ms=ttft * 1e3,
+        decode_mean_ms=mean * 1e3,
+        decode_p50_ms=_percentile(latencies, 50) * 1e3,
+        decode_p99_ms=_percentile(latencies, 99) * 1e3,
+        decode_tokens_per_sec=batch_size / mean,
+    )
+
+
+def measure_case(
+    name: str,
+    dtype_name: str,
+    batch_size: int,
+    prompt_length: int,
+    new_tokens: int,
+    warmup: int,
+    repeats: int,
+    device: torch.device,
+    num_threads: Optional[int],
+    seed: int,
+) -> Dict[str, float]:
+    """The median metrics of ``repeats`` runs of one combination, and the peak RSS of the calling process.
+
+    Meant to run alone in a fresh process, the peak RSS then covers exactly this combination, including the memory
+    the interpreter and torch take before it starts.
+    """
+    if device.type == "cpu":
+        configure_cpu_threads(num_threads)
+    model = build_model(name, device, getattr(torch, dtype_name), seed)
+    for _ in range(warmup):
+        run_case(model, batch_size, prompt_length, new_tokens, device, seed)
+    runs = [run_case(model, batch_size, prompt_length, new_tokens, device, seed) for _ in range(repeats)]
+    metrics = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+    return dict(metrics, peak_rss_mb=peak_rss_mb())
+
+
+def main(
+    configs: List[str] = ["nano", "small"],
+    batch_sizes: List[int] = [1, 4],
+    prompt_lengths: List[int] = [32, 256],
+    dtypes: List[str] = ["float32", "bfloat16"],
+    new_tokens: int = 32,
+    warmup: int = 1,
+    repeats: int = 3,
+    device: str = "cpu",
+    num_threads: Optional[int] = None,
+    output: Optional[Path] = None,
+    seed: int = 1234,
+) -> None:
+    """Benchmarks every combination of the given synthetic configs, batch sizes, prompt lengths and dtypes.
+
+    Args:
+        configs: Names from ``synthetic_configs``.
+        batch_sizes: The numbers of prompts decoded together.
+        prompt_lengths: The prompt lengths, in tokens.
+        dtypes: The weight and KV cache dtypes, e.g. ``"float32"`` or ``"bfloat16"``.
+        new_tokens: The number of tokens generated per prompt.
+        warmup: Untimed runs per combination before measuring.
+        repeats: Timed runs per combination. Every metric is the median over them.
+        device: The device to run on, ``"auto"`` picks the best available.
+        num_threads: On CPU, the intra-op threads.
+        output: If specified, write the results here as JSON, otherwise to stdout.
+        seed: Seeds the weights and prompts, so reruns measure the same work.
+    """
+    device = pick_device(device)
+    if device.type == "cpu":
+        configure_cpu_threads(num_threads)
+
+    results = []
+    # ``ru_maxrss`` is a peak over the whole process lifetime, so every combination gets a process of its own. Spawned,
+    # not forked, so it starts without the parent's memory or CUDA context
+    context = multiprocessing.get_context("spawn")
+    for name in configs:
+        for dtype_name in dtypes:
+            for batch_size in batch_sizes:
+                for prompt_length in prompt_lengths:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        metrics = executor.submit(
+                            measure_case, name, dtype_name, batch_size, prompt_length, new_tokens, warmup, repeats,
+                            device, num_threads, seed,
+                        ).result()
+                    result = dict(
+                        config=name, dtype=dtype_name, batch_size=batch_size, prompt_length=prompt_length, **metrics
+                    )
+                    results.append(result)
+                    print(
+                        f"{name} {dtype_name} batch {batch_size} prompt {prompt_length}: ttft {result['ttft_ms']:.02f} ms,"
+                        f" decode p50 {result['decode_p50_ms']:.02f} ms p99 {result['decode_p99_ms']:.02f} ms,"
+                        f" {result['decode_tokens_per_sec']:.01f} tokens/sec, peak rss {result['peak_rss_mb']:.0f} MB",
+                        file=sys.stderr,
+                    )
+
+    report = dict(
+        environment=dict(
+            torch=torch.__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            device=str(device),
+            num_threads=torch.get_num_threads(),
+        ),
+        settings=dict(new_tokens=new_tokens, warmup=warmup, repeats=repeats, seed=seed),
+        results=results,
+    )
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    torch.set_float32_matmul_precision("high")
+    CLI(main)
@@ -0,0 +1,81 @@
+"""Rewrites a lit-llama checkpoint in the layout inference runs fastest from.
+
+Compared to the training layout:
+
+* every MLP's gate and up projections (``c_fc1``, ``c_fc2``) are stacked into one ``c_fc``, so ``FusedMLP`` reads its
+  input with one GEMM twice as wide instead of two,
+* every floating point tensor is cast once, here, to the dtype the model runs in, so loading never casts and the
+  norms, embeddings and projections all agree,
+* the result is written in the mmap format of ``convert_mmap.py``, each tensor contiguous and 64-byte aligned, so it
+  is mapped straight into the model without a copy.
+
+``generate.py`` and the other loaders recognize the fused layout and build the model with ``fused_mlp=True``::
+
+    python convert_inference.py --checkpoint_path checkpoints/lit-llama/7B/lit-llama.pth --output_path 7B.inference
+
+A checkpoint written by ``quantize.py`` stays quantized. Every buffer of its quantized layers (weights, scales and zero
+points) holds one row per output feature, so the gate and up buffers are stacked the same way. Load the result with
+the same ``--quantize`` mode::
+
+    python quantize.py convert --checkpoint_path lit-llama.pth --output_path lit-llama-int8.pth --mode int8
+    python convert_inference.py --checkpoint_path lit-llama-int8.pth --output_path 7B-int8.inference
+    python generate.py --checkpoint_path 7B-int8.inference --quantize int8
+"""
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional
+
+import torch
+
+from utils import is_mmap_checkpoint, lazy_load, mmap_load, pick_dtype, save_mmap_checkpoint
+
+
+class _Stacked:
+    """Tensors concatenated along dim 0, only materialized when ``save_mmap_checkpoint`` writes them."""
+
+    def __init__(self, parts: List) -> None:
+        self.parts = parts
+        self.shape = torch.Size([sum(p.shape[0] for p in parts), *parts[0].shape[1:]])
+        self.dtype = parts[0].dtype
+
+    def _load_tensor(self) -> torch.Tensor:
+        return torch.cat([p._load_tensor() if hasattr(p, "_load_tensor") else p for p in self.parts])
+
+
+def inference_layout(checkpoint: Mapping) -> Dict:
+    """The tensors of ``checkpoint`` in the fused layout, in checkpoint order. Nothing is loaded yet.
+
+    Every ``c_fc1`` tensor is stacked with its ``c_fc2`` counterpart: the float weight, or all buffers of a quantized
+    layer.
+    """
+    converted = {}
+    for name, tensor in checkpoint.items():
+        prefix, _, suffix = name.partition("mlp.c_fc1.")
+        if suffix:
+            converted[prefix + "mlp.c_fc." + suffix] = _Stacked([tensor, checkpoint[prefix + "mlp.c_fc2." + suffix]])
+        elif "mlp.c_fc2." not in name:
+            converted[name] = tensor
+    return converted
+
+
+@torch.no_grad()
+def convert(checkpoint_path: Path, output_path: Path, dtype: Optional[str] = None) -> None:
+    """Converts a checkpoint to the inference layout.
+
+    Args:
+        checkpoint_path: The lit-llama checkpoint to convert, as saved by ``torch.save``, ``quantize.py`` or
+            ``convert_mmap.py``.
+        output_path: Where to write the converted checkpoint.
+        dtype: The dtype every floating point tensor is cast to, e.g. ``"bfloat16"``, including the scales and zero
+            points of quantized layers. Defaults to bfloat16 or float32 depending on whether this CPU has native bf16
+            support.
+    """
+    dtype = pick_dtype(torch.device("cpu")) if dtype is None else getattr(torch, dtype)
+    load = mmap_load if is_mmap_checkpoint(checkpoint_path) else lazy_load
+    with load(checkpoint_path) as checkpoint:
+        save_mmap_checkpoint(inference_layout(checkpoint), output_path, dtype=dtype)
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(convert)
@@ -0,0 +1,30 @@
+"""Rewrites a lit-llama checkpoint in the flat format that ``generate.py`` memory-maps instead of unpickling.
+
+Tensors are streamed one at a time from ``lazy_load``, so the source checkpoint never has to fit in memory. Quantized
+checkpoints from ``quantize.py`` convert the same way; load them with the matching ``--quantize`` mode.
+"""
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+from utils import lazy_load, save_mmap_checkpoint
+
+
+@torch.no_grad()
+def convert(checkpoint_path: Path, output_path: Path, dtype: Optional[str] = None) -> None:
+    """Converts a checkpoint to the mmap format.
+
+    Args:
+        checkpoint_path: The lit-llama checkpoint to convert.
+        output_path: Where to write the converted checkpoint.
+        dtype: If specified, cast floating point tensors to this dtype, e.g. ``"float16"`` or ``"bfloat16"``.
+    """
+    with lazy_load(checkpoint_path) as checkpoint:
+        save_mmap_checkpoint(checkpoint, output_path, dtype=getattr(torch, dtype) if dtype is not None else None)
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(convert)
@@ -0,0 +1,208 @@
+"""Continuous batching on top of LLaMA's per-layer KV caches.
+
+Every active request owns one row ("slot") of the ``KVCache`` tensors. Waiting requests are admitted into free slots
+between decode steps and finished ones are evicted, while all active slots advance together in one batched
+``LLaMA.forward`` per step. With chunked prefill, a long prompt is fed one chunk per step so it does not stall the
+decoding of the other slots.
+"""
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import torch
+
+from generate import decode_one_token, prefill
+from model import LLaMA
+from prefix_cache import PrefixCache
+
+
+@dataclass
+class GenerationRequest:
+    prompt: torch.Tensor
+    max_new_tokens: int
+    eos_id: Optional[int] = None
+    request_id: int = 0
+    tokens: List[int] = field(default_factory=list)
+    finished: bool = False
+
+    @property
+    def output(self) -> torch.Tensor:
+        """The prompt followed by the tokens generated so far."""
+        new = torch.tensor(self.tokens, dtype=self.prompt.dtype, device=self.prompt.device)
+        return torch.cat([self.prompt, new])
+
+
+class ContinuousBatchingEngine:
+    """Schedules generation requests onto the batch rows of the model's KV caches.
+
+    Args:
+        model: The model to use. Its caches are set up once with ``max_batch_size`` slots.
+        max_batch_size: The number of requests decoded concurrently.
+        max_seq_length: The maximum prompt plus generated length of any single request.
+        temperature: Scales the predicted logits by 1 / temperature
+        top_k: If specified, only sample among the tokens with the k highest probabilities
+        page_size: If specified, use a paged KV cache so slots only hold blocks for the tokens they need
+        num_blocks: The number of KV cache blocks in the paged pool, see ``LLaMA.setup_caches``
+        prefix_cache: If specified, admitted prompts restore cached prefix K/V and only prefill the rest
+        quantize_kv_cache: Whether to store the KV cache as int8, fitting about twice the slots in the same memory
+        prefill_chunk_size: If specified, prompts are prefilled at most this many tokens per step, interleaved with
+            the decode steps of the active slots
+    """
+
+    def __init__(
+        self,
+        model: LLaMA,
+        max_batch_size: int,
+        max_seq_length: int,
+        *,
+        temperature: float = 1.0,
+        top_k: Optional[int] = None,
+        page_size: Optional[int] = None,
+        num_blocks: Optional[int] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+        quantize_kv_cache: bool = False,
+        prefill_chunk_size: Optional[int] = None,
+    ) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_seq_length = max_seq_length
+        self.sampling_kwargs = dict(temperature=temperature, top_k=top_k)
+        self.device = model.transformer.wte.weight.device
+        self.prefix_cache = prefix_cache
+        self.prefill_chunk_size = prefill_chunk_size
+
+        model.setup_caches(
+            max_batch_size=max_batch_size,
+            max_seq_length=max_seq_length,
+            page_size=page_size,
+            num_blocks=num_blocks,
+            quantize_kv_cache=quantize_kv_cache,
+        )
+
+        self.waiting: Deque[GenerationRequest] = deque()
+        self.active: Dict[int, GenerationRequest] = {}
+        # slots whose prompt is still being prefilled, with the position of the next chunk
+        self.prefilling: Dict[int, Tuple[GenerationRequest, int]] = {}
+        self.free_slots: Deque[int] = deque(range(max_batch_size))
+        # free slots decode a dummy token at the last position, which every request writes before it attends to it
+        self.positions = [max_seq_length - 1] * max_batch_size
+        self.cur_token = torch.zeros(max_batch_size, dtype=torch.int, device=self.device)
+        self._next_id = 0
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self.waiting or self.active or self.prefilling)
+
+    def add_request(
+        self, prompt: torch.Tensor, max_new_tokens: int, eos_id: Optional[int] = None
+    ) -> GenerationRequest:
+        """Queues a prompt; it is admitted into a slot on the next ``step`` that has one free."""
+        # the token sampled from the prompt is always kept, so every request generates at least one
+        if max_new_tokens < 1:
+            raise ValueError(f"max_new_tokens must be at least 1, got {max_new_tokens}")
+        if prompt.size(0) + max_new_tokens > self.max_seq_length:
+            raise ValueError(
+                f"Prompt of length {prompt.size(0)} plus {max_new_tokens} new tokens does not fit in max seq length"
+                f" {self.max_seq_length}"
+            )
+        request = GenerationRequest(prompt, max_new_tokens, eos_id=eos_id, request_id=self._next_id)
+        self._next_id += 1
+        self.waiting.append(request)
+        return request
+
+    @torch.no_grad()
+    def step(self) -> List[GenerationRequest]:
+        """Admits waiting requests, prefills a chunk of each admitted prompt, runs one batched decode step over the
+        active slots and returns the requests that finished."""
+        finished = self._admit()
+        if self.prefilling:
+            finished += self._prefill()
+        if self.active:
+            finished += self._decode()
+        return finished
+
+    def run(self) -> Iterator[GenerationRequest]:
+        """Steps until every queued request is done, yielding each one as it finishes."""
+        while self.has_pending:
+            yield from self.step()
+
+    def _admit(self) -> List[GenerationRequest]:
+        finished = []
+        while self.waiting and self.free_slots:
+            request = self.waiting[0]
+            T = request.prompt.size(0)
+            # reserving the whole request up front means a running request never runs out of blocks
+            if not self.model.kv_caches.can_reserve(T + request.max_new_tokens):
+                break
+            self.waiting.popleft()
+            slot = self.free_slots.popleft()
+            self.model.kv_caches.reserve(slot, T + request.max_new_tokens)
+            start = 0
+            if self.prefix_cache is not None:
+                start = self.prefix_cache.load(self.model, slot, request.prompt.tolist())
+            if self.prefill_chunk_size is not None:
+                self.prefilling[slot] = (request, start)
+                continue
+            token = self._prefill_tokens(slot, request, start, T)
+            if self._activate(slot, request, token):
+                finished.append(request)
+        return finished
+
+    def _prefill(self) -> List[GenerationRequest]:
+        finished = []
+        for slot, (request, start) in list(self.prefilling.items()):
+            T = request.prompt.size(0)
+            end = min(start + self.prefill_chunk_size, T)
+            token = self._prefill_tokens(slot, request, start, end)
+            if end < T:
+                self.prefilling[slot] = (request, end)
+                continue
+            del self.prefilling[slot]
+            if self._activate(slot, request, token):
+                finished.append(request)
+        return finished
+
+    def _prefill_tokens(self, slot: int, request: GenerationRequest, start: int, end: int) -> torch.Tensor:
+        # writes prompt tokens [start, end) into the slot's cache and samples from the logits of the last one
+        return prefill(
+            self.model,
+            torch.arange(start, end, device=self.device),
+            request.prompt[start:end].view(1, -1).to(self.device),
+            torch.tensor([end - start], device=self.device),
+            slot_idx=torch.tensor([slot], device=self.device),
+            **self.sampling_kwargs,
+        )
+
+    def _activate(self, slot: int, request: GenerationRequest, token: torch.Tensor) -> bool:
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(self.model, slot, request.prompt.tolist())
+        self.active[slot] = request
+        self.positions[slot] = request.prompt.size(0)
+        self.cur_token[slot] = token[0]
+        return self._append(slot, request, token.item())
+
+    def _decode(self) -> List[GenerationRequest]:
+        input_pos = torch.tensor(self.positions, device=self.device).view(-1, 1)
+        next_token = decode_one_token(
+            self.model, input_pos, self.cur_token.view(-1, 1), **self.sampling_kwargs
+        )
+        self.cur_token = next_token
+
+        finished = []
+        tokens = next_token.tolist()
+        for slot, request in list(self.active.items()):
+            self.positions[slot] += 1
+            if self._append(slot, request, tokens[slot]):
+                finished.append(request)
+        return finished
+
+    def _append(self, slot: int, request: GenerationRequest, token: int) -> bool:
+        request.tokens.append(token)
+        if len(request.tokens) < request.max_new_tokens and token != request.eos_id:
+            return False
+        request.finished = True
+        del self.active[slot]
+        self.model.kv_caches.release(slot)
+        self.positions[slot] = self.max_seq_length - 1
+        self.free_slots.append(slot)
+        return True
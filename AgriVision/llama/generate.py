@@ -1,15 +1,16 @@
 from jsonargparse import CLI
+import asyncio
+import json
 import sys
 import time
 import warnings
 from pathlib import Path
-from typing import Optional
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
 import itertools
 
 import lightning as L
 import torch
 
-torch.device("mps" if torch.backends.mps.is_available() else "cpu")
 import torch._dynamo
 torch._dynamo.config.suppress_errors = True
 
@@ -26,38 +27,110 @@ torch._inductor.config.triton.unique_kernel_names = False
 wd = Path(__file__).parent.parent.resolve()
 sys.path.append(str(wd))
 
+from instrumentation import Instrumentation
 from model import LLaMA
-from tokenizer import Tokenizer
-from utils import lazy_load, llama_model_lookup
+from offload import load_offloaded_model
+from prefix_cache import PrefixCache
+from tokenizer import IncrementalDecoder, Tokenizer
+from utils import (
+    configure_cpu_threads,
+    is_fused_mlp_checkpoint,
+    is_mmap_checkpoint,
+    lazy_load,
+    llama_model_lookup,
+    load_state_dict_parallel,
+    mmap_load,
+    pick_device,
+    pick_dtype,
+    quantization,
+)
 
 def fast_multinomial_sample_one(probs_sort):
     q = torch.empty_like(probs_sort).exponential_(1)
     return torch.argmax(probs_sort / q, dim=-1, keepdim=True)
 
-def sample(logits, temperature: float = 1.0, top_k: Optional[int] = None):
-    logits =  logits[0, -1] / temperature
+def logits_to_probs(logits, temperature: float = 1.0, top_k: Optional[int] = None):
+    # logits: [..., V], every leading row is sampled independently
+    logits = logits / max(temperature, 1e-5)
 
     # optionally crop the logits to only the top k options
     if top_k is not None:
         v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-        logits = torch.where(logits < v[-1], -float("Inf"), logits)
+        pivot = v[..., -1:]
+        logits = torch.where(logits < pivot, -float("Inf"), logits)
 
+    return torch.nn.functional.softmax(logits, dim=-1)
 
-    probs = torch.nn.functional.softmax(logits, dim=-1)
-    # print()
-    idx_next = fast_multinomial_sample_one(probs).to(dtype=torch.int)
+def sample(logits, temperature: float = 1.0, top_k: Optional[int] = None):
+    # logits: [B, V] -> one token per row, [B]
+    probs = logits_to_probs(logits, temperature, top_k)
     # idx_next = torch.multinomial(probs, num_samples=1).to(dtype=torch.int)
-    return idx_next
+    idx_next = fast_multinomial_sample_one(probs).to(dtype=torch.int)
+    return idx_next.squeeze(-1)
 
 def prefill(
     model: LLaMA,
     input_pos: torch.Tensor,
     x: torch.Tensor,
+    lengths: torch.Tensor,
+    slot_idx: Optional[torch.Tensor] = None,
     **kwargs
 ):
-    # input_pos: [B, S]
-    logits = model(x, input_pos)
-    return sample(logits, **kwargs)
+    # input_pos: [S] or [B, S], x: [B, S] right-padded, lengths: [B], slot_idx: optional [B] cache rows
+    logits = model(x, input_pos, slot_idx, logits_idx=lengths - 1)
+    return sample(logits[:, -1], **kwargs)
+
+def prefill_chunked(
+    model: LLaMA,
+    input_pos: torch.Tensor,
+    x: torch.Tensor,
+    lengths: torch.Tensor,
+    chunk_size: int,
+    slot_idx: Optional[torch.Tensor] = None,
+    **kwargs
+):
+    # like prefill, but feeds the cache chunk_size tokens at a time so activations and the mask scale with the chunk
+    # rather than the prompt; each row keeps the logits of the chunk holding its last token
+    last = lengths - 1
+    logits = None
+    for start in range(0, x.size(1), chunk_size):
+        end = min(start + chunk_size, x.size(1))
+        chunk_logits = model(x[:, start:end], input_pos[..., start:end], slot_idx, logits_idx=(last - start).clamp(0, end - start - 1))
+        in_chunk = ((last >= start) & (last < end)).view(-1, 1, 1)
+        logits = chunk_logits if logits is None else torch.where(in_chunk, chunk_logits, logits)
+    return sample(logits[:, -1], **kwargs)
+
+# prompt lengths prefill is padded to, so a compiled prefill only ever sees this many shapes
+PREFILL_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048)
+
+def prefill_bucket(length: int, buckets: Sequence[int], max_seq_length: int) -> int:
+    """The smallest bucket that fits ``length`` tokens, capped at the cache length."""
+    for bucket in buckets:
+        if bucket >= length:
+            return max(min(bucket, max_seq_length), length)
+    return length
+
+@torch.no_grad()
+def warmup_prefill(
+    model: LLaMA,
+    max_seq_length: int,
+    buckets: Sequence[int] = PREFILL_BUCKETS,
+    batch_size: int = 1,
+    dtype: torch.dtype = torch.int,
+    **kwargs
+) -> None:
+    """Runs prefill once per bucket so every compiled prefill graph exists before the first request arrives.
+
+    ``max_seq_length``, ``batch_size`` and the sampling ``kwargs`` must match the later calls, or they recompile.
+    """
+    device = model.transformer.wte.weight.device
+    model.setup_caches(max_batch_size=batch_size, max_seq_length=max_seq_length)
+    # prefill_bucket caps every bucket past the cache at the cache length, so those all share its shape
+    for S in sorted({b for b in buckets if b <= model.max_seq_length} | {model.max_seq_length}):
+        x = torch.zeros(batch_size, S, dtype=dtype, device=device)
+        lengths = torch.full((batch_size,), S, device=device)
+        prefill(model, torch.arange(0, S, device=device), x, lengths, **kwargs)
+    model.reset_cache()
 
 def decode_one_token(
     model: LLaMA,
@@ -68,9 +141,348 @@ def decode_one_token(
     # input_pos: [B, 1]
     assert input_pos.shape[-1] == 1
     logits = model(x, input_pos)
-    return sample(logits, **kwargs)
+    return sample(logits[:, -1], **kwargs)
+
+def prefill_batch(
+    model: LLaMA,
+    prompts: List[torch.Tensor],
+    starts: List[int],
+    prefill_buckets: Optional[Sequence[int]] = None,
+    prefill_chunk_size: Optional[int] = None,
+    **kwargs
+) -> torch.Tensor:
+    # prefills prompt i from position starts[i] on into cache row i, right-padded to a common (bucketed) length,
+    # and samples the first new token of every row
+    device, dtype = prompts[0].device, prompts[0].dtype
+    suffix_lengths = torch.tensor([p.size(0) - start for p, start in zip(prompts, starts)], device=device)
+    S = int(suffix_lengths.max())
+    if prefill_buckets is not None:
+        S = prefill_bucket(S, prefill_buckets, model.max_seq_length)
+    x = torch.zeros(len(prompts), S, dtype=dtype, device=device)
+    for i, (p, start) in enumerate(zip(prompts, starts)):
+        x[i, :p.size(0) - start] = p[start:]
+    if any(starts):
+        input_pos = torch.tensor(starts, device=device).view(-1, 1) + torch.arange(0, S, device=device)
+    else:
+        input_pos = torch.arange(0, S, device=device)
+    # padding past a row's end may run off the cache; it is overwritten or masked either way
+    input_pos = input_pos.clamp(max=model.max_seq_length - 1)
+    if prefill_chunk_size is not None and S > prefill_chunk_size:
+        return prefill_chunked(model, input_pos, x, suffix_lengths, prefill_chunk_size, **kwargs)
+    return prefill(model, input_pos, x, suffix_lengths, **kwargs)
 
 @torch.no_grad()
+def generate_batch(
+    model: LLaMA,
+    prompts: List[torch.Tensor],
+    max_new_tokens: int,
+    *,
+    max_seq_length: Optional[int] = None,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    page_size: Optional[int] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+    quantize_kv_cache: bool = False,
+    attention_sinks: Optional[int] = None,
+    prefill_buckets: Optional[Sequence[int]] = None,
+    prefill_chunk_size: Optional[int] = None,
+    sync_every: int = 16,
+) -> List[torch.Tensor]:
+    """Continues a batch of prompts of different lengths in lockstep.
+
+    Prompts are right-padded and prefilled together, then every decode step samples one token for all rows in a
+    single forward pass. Each row tracks its own position, so padding never shifts the real tokens.
+
+    Args:
+        model: The model to use.
+        prompts: List of tensors of shape (T_i) with indices of each prompt sequence.
+        max_new_tokens: The number of new tokens to generate per prompt.
+        max_seq_length: The maximum sequence length allowed.
+        temperature: Scales the predicted logits by 1 / temperature
+        top_k: If specified, only sample among the tokens with the k highest probabilities
+        eos_id: If specified, a row stops generating once the <eos> token is triggered
+        page_size: If specified, use a paged KV cache with blocks of this many tokens
+        prefix_cache: If specified, restore the K/V of cached prompt prefixes and only prefill the rest
+        quantize_kv_cache: Whether to store the KV cache as int8
+        attention_sinks: If specified, stream with this many attention-sink tokens plus a rolling window so that
+            ``max_seq_length`` bounds the cache instead of the sequence, and generation can run past ``block_size``
+        prefill_buckets: If specified, pad the prefilled tokens to the smallest of these lengths that fits, see
+            ``warmup_prefill``. Ignored when streaming with attention sinks.
+        prefill_chunk_size: If specified, prefill at most this many tokens per forward pass to bound peak memory
+        sync_every: How many decode steps run between checks whether every row has hit <eos>. Each check waits for
+            the device; up to ``sync_every - 1`` steps may run past the last <eos> and are trimmed.
+
+    Returns:
+        One tensor per prompt holding the prompt followed by its generated tokens (including <eos> if sampled).
+    """
+    B = len(prompts)
+    device, dtype = prompts[0].device, prompts[0].dtype
+    lengths = torch.tensor([p.size(0) for p in prompts], device=device)
+    T = max(p.size(0) for p in prompts)
+    T_new = T + max_new_tokens
+    if attention_sinks is not None:
+        if prefix_cache is not None:
+            raise ValueError("Prefix caching is not supported with attention sinks")
+        if max_seq_length is None:
+            # the streamed chunk is attended together with the whole cache, both have to fit in block_size
+            max_seq_length = min(T_new, model.config.block_size // 2)
+    else:
+        if max_seq_length is None:
+            max_seq_length = min(T_new, model.config.block_size)
+        max_new_tokens = min(max_new_tokens, max_seq_length - T)
+    model.setup_caches(
+        max_batch_size=B,
+        max_seq_length=max_seq_length,
+        page_size=page_size,
+        quantize_kv_cache=quantize_kv_cache,
+        attention_sinks=attention_sinks,
+    )
+    for i, p in enumerate(prompts):
+        model.kv_caches.reserve(i, p.size(0) + max_new_tokens)
+
+    # create an empty tensor of the expected final shape and fill in the current tokens
+    seq = torch.zeros(B, T + max_new_tokens, dtype=dtype, device=device)
+    for i, p in enumerate(prompts):
+        seq[i, :p.size(0)] = p
+
+    starts = [0] * B
+    if prefix_cache is not None:
+        starts = [prefix_cache.load(model, i, p.tolist()) for i, p in enumerate(prompts)]
+    if attention_sinks is not None:
+        # the ring buffer cannot absorb right padding, so each prompt streams into its own row a window at a time
+        window = max_seq_length - attention_sinks
+        next_token = torch.empty(B, dtype=torch.int, device=device)
+        for i, p in enumerate(prompts):
+            for start in range(0, p.size(0), window):
+                chunk = p[start : start + window]
+                next_token[i] = prefill(
+                    model,
+                    torch.arange(start, start + chunk.size(0), device=device),
+                    chunk.view(1, -1),
+                    torch.tensor([chunk.size(0)], device=device),
+                    slot_idx=torch.tensor([i], device=device),
+                    temperature=temperature,
+                    top_k=top_k,
+                )[0]
+    else:
+        next_token = prefill_batch(
+            model,
+            prompts,
+            starts,
+            prefill_buckets=prefill_buckets,
+            prefill_chunk_size=prefill_chunk_size,
+            temperature=temperature,
+            top_k=top_k,
+        )
+    if prefix_cache is not None:
+        for i, p in enumerate(prompts):
+            prefix_cache.store(model, i, p.tolist())
+
+    return _decode_batch(
+        model, seq, lengths, next_token, max_new_tokens, temperature=temperature, top_k=top_k, eos_id=eos_id, sync_every=sync_every
+    )
+
+def _decode_batch(
+    model: LLaMA,
+    seq: torch.Tensor,
+    lengths: torch.Tensor,
+    next_token: torch.Tensor,
+    max_new_tokens: int,
+    *,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    sync_every: int = 16,
+) -> List[torch.Tensor]:
+    # decodes every row of seq ([B, T_max]) in lockstep from its prefilled length, starting with the already sampled
+    # next_token, and returns each row up to its <eos>
+    B, dtype = seq.size(0), seq.dtype
+    rows = torch.arange(B, device=seq.device)
+
+    # static buffers updated in place, so a step never allocates or waits on the device: per-row position of the
+    # token being written, the token fed to the next step, the length each row has reached and its <eos> state
+    input_pos = lengths.view(B, 1).clone()
+    cur_token = next_token.view(B, 1).clone()
+    seq_lengths = lengths.clone()
+    done = torch.zeros(B, dtype=torch.bool, device=seq.device)
+
+    for i in range(max_new_tokens):
+        if i > 0:
+            # forward cur_token at the position it was written to; copy out of the result, which a CUDA graph replay
+            # may overwrite on the next step
+            cur_token.copy_(decode_one_token(model, input_pos, cur_token, temperature=temperature, top_k=top_k).view(B, 1))
+            # advance, the sampled token goes right after the one fed
+            input_pos += 1
+
+        # rows that already finished keep decoding in lockstep, their extra tokens are trimmed below
+        seq[rows, input_pos[:, 0]] = cur_token[:, 0].to(dtype)
+        torch.where(done, seq_lengths, input_pos[:, 0] + 1, out=seq_lengths)
+        if eos_id is not None:
+            done |= cur_token[:, 0] == eos_id
+
+        # reading done back stalls until the device catches up, so only check every sync_every steps whether every
+        # row has triggered <eos>
+        if eos_id is not None and (i + 1) % sync_every == 0 and done.all():
+            break
+
+    return [seq[i, :n] for i, n in enumerate(seq_lengths.tolist())]
+
+def _prefill_shared(
+    model: LLaMA,
+    prompt: torch.Tensor,
+    n: int,
+    max_new_tokens: int,
+    max_seq_length: Optional[int],
+    page_size: Optional[int],
+    quantize_kv_cache: bool,
+) -> Tuple[torch.Tensor, int]:
+    # sets up n cache rows, prefills the prompt into row 0 only and copies its K/V into the other rows; returns the
+    # logits of the prompt's last token, [1, V], and the number of tokens that still fit
+    device = prompt.device
+    T = prompt.size(0)
+    if max_seq_length is None:
+        max_seq_length = min(T + max_new_tokens, model.config.block_size)
+    max_new_tokens = min(max_new_tokens, max_seq_length - T)
+    model.setup_caches(
+        max_batch_size=n, max_seq_length=max_seq_length, page_size=page_size, quantize_kv_cache=quantize_kv_cache
+    )
+    for i in range(n):
+        model.kv_caches.reserve(i, T + max_new_tokens)
+
+    logits = model(
+        prompt.view(1, -1),
+        torch.arange(0, T, device=device),
+        torch.tensor([0], device=device),
+        logits_idx=torch.tensor([T - 1], device=device),
+    )[:, -1]
+    if n > 1:
+        model.kv_caches.copy_rows(torch.zeros(n - 1, dtype=torch.long, device=device), torch.arange(1, n, device=device))
+    return logits, max_new_tokens
+
+@torch.no_grad()
+def generate_n(
+    model: LLaMA,
+    prompt: torch.Tensor,
+    n: int,
+    max_new_tokens: int,
+    *,
+    max_seq_length: Optional[int] = None,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    page_size: Optional[int] = None,
+    quantize_kv_cache: bool = False,
+    sync_every: int = 16,
+) -> List[torch.Tensor]:
+    """Samples ``n`` independent continuations of one prompt for the cost of a single prefill.
+
+    The prompt is prefilled once into cache row 0, its K/V are copied into rows 1 to ``n - 1``, and the samples are
+    then decoded together as one batch, each starting from its own draw from the prompt's last logits.
+
+    Args:
+        model: The model to use.
+        prompt: Tensor of shape (T) with indices of the prompt sequence.
+        n: The number of samples.
+        max_new_tokens: The number of new tokens to generate per sample.
+        max_seq_length: The maximum sequence length allowed.
+        temperature: Scales the predicted logits by 1 / temperature
+        top_k: If specified, only sample among the tokens with the k highest probabilities
+        eos_id: If specified, a sample stops generating once the <eos> token is triggered
+        page_size: If specified, use a paged KV cache with blocks of this many tokens
+        quantize_kv_cache: Whether to store the KV cache as int8
+        sync_every: How many decode steps run between checks for <eos>, see ``generate_batch``
+
+    Returns:
+        ``n`` tensors holding the prompt followed by the generated tokens (including <eos> if sampled).
+    """
+    logits, max_new_tokens = _prefill_shared(model, prompt, n, max_new_tokens, max_seq_length, page_size, quantize_kv_cache)
+    next_token = sample(logits.expand(n, -1), temperature=temperature, top_k=top_k)
+
+    T = prompt.size(0)
+    seq = torch.zeros(n, T + max_new_tokens, dtype=prompt.dtype, device=prompt.device)
+    seq[:, :T] = prompt
+    lengths = torch.full((n,), T, device=prompt.device)
+    return _decode_batch(
+        model, seq, lengths, next_token, max_new_tokens, temperature=temperature, top_k=top_k, eos_id=eos_id, sync_every=sync_every
+    )
+
+@torch.no_grad()
+def beam_search(
+    model: LLaMA,
+    prompt: torch.Tensor,
+    beam_width: int,
+    max_new_tokens: int,
+    *,
+    max_seq_length: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    length_penalty: float = 1.0,
+    page_size: Optional[int] = None,
+    quantize_kv_cache: bool = False,
+) -> torch.Tensor:
+    """Continues the prompt with the most likely sequence found by a beam search of width ``beam_width``.
+
+    Like ``generate_n``, the prompt is prefilled once and its K/V copied into every beam's cache row. After each step
+    the ``beam_width`` best continuations of all beams are kept, and the cache rows are reordered to follow their
+    parent beams with one index-select per cache tensor.
+
+    Args:
+        model: The model to use.
+        prompt: Tensor of shape (T) with indices of the prompt sequence.
+        beam_width: The number of beams kept.
+        max_new_tokens: The number of new tokens to generate.
+        max_seq_length: The maximum sequence length allowed.
+        eos_id: If specified, a beam is finished once it emits <eos> and keeps its score from then on
+        length_penalty: Finished beams are ranked by their log-probability divided by length ** length_penalty
+        page_size: If specified, use a paged KV cache with blocks of this many tokens
+        quantize_kv_cache: Whether to store the KV cache as int8
+
+    Returns:
+        The prompt followed by the best beam's tokens (including <eos> if it finished).
+    """
+    W = beam_width
+    device = prompt.device
+    T = prompt.size(0)
+    logits, max_new_tokens = _prefill_shared(model, prompt, W, max_new_tokens, max_seq_length, page_size, quantize_kv_cache)
+    V = logits.size(-1)
+    # the beams start as the top W first tokens, not W copies of the best one
+    scores, cur_token = torch.log_softmax(logits[0].float(), dim=-1).topk(W)
+    cur_token = cur_token.to(prompt.dtype)
+
+    seq = torch.zeros(W, T + max_new_tokens, dtype=prompt.dtype, device=device)
+    seq[:, :T] = prompt
+    seq[:, T] = cur_token
+    lengths = torch.full((W,), T + 1, device=device)
+    done = cur_token == eos_id if eos_id is not None else torch.zeros(W, dtype=torch.bool, device=device)
+    rows = torch.arange(W, device=device)
+    # a finished beam may only continue with <eos> at no cost, so it keeps its score and is never duplicated
+    finished_row = torch.full((V,), -float("Inf"), device=device)
+    if eos_id is not None:
+        finished_row[eos_id] = 0.0
+
+    input_pos = torch.full((W, 1), T, device=device)
+    for i in range(1, max_new_tokens):
+        if eos_id is not None and done.all():
+            break
+        log_probs = torch.log_softmax(model(cur_token.view(W, 1), input_pos)[:, -1].float(), dim=-1)
+        log_probs = torch.where(done.view(W, 1), finished_row, log_probs)
+        scores, idx = (scores.view(W, 1) + log_probs).view(-1).topk(W)
+        beam_idx, token = idx // V, (idx % V).to(prompt.dtype)
+
+        # every surviving beam continues from its parent: gather the parents' tokens and K/V
+        seq = seq[beam_idx]
+        lengths = torch.where(done[beam_idx], lengths[beam_idx], lengths[beam_idx] + 1)
+        done = done[beam_idx]
+        model.kv_caches.copy_rows(beam_idx, rows)
+        seq[rows, T + i] = token
+        if eos_id is not None:
+            done |= token == eos_id
+        cur_token = token
+        input_pos += 1
+
+    best = int((scores / lengths.sub(T).float().pow(length_penalty)).argmax())
+    return seq[best, : int(lengths[best])]
+
 def generate(
     model: LLaMA,
     prompt: torch.Tensor,
@@ -80,6 +492,8 @@ def generate(
     temperature: float = 1.0,
     top_k: Optional[int] = None,
     eos_id: Optional[int] = None,
+    prefill_buckets: Optional[Sequence[int]] = None,
+    sync_every: int = 16,
 ) -> torch.Tensor:
     """Takes a conditioning sequence (prompt) as input and continues to generate as many tokens as requested.
 
@@ -93,44 +507,272 @@ def generate(
         temperature: Scales the predicted logits by 1 / temperature
         top_k: If specified, only sample among the tokens with the k highest probabilities
         eos_id: If specified, stop generating any more token once the <eos> token is triggered
+        prefill_buckets: If specified, pad the prompt to the smallest of these lengths that fits it
+        sync_every: How many decode steps run between checks for <eos>, see ``generate_batch``
+    """
+    return generate_batch(
+        model,
+        [prompt],
+        max_new_tokens,
+        max_seq_length=max_seq_length,
+        temperature=temperature,
+        top_k=top_k,
+        eos_id=eos_id,
+        prefill_buckets=prefill_buckets,
+        sync_every=sync_every,
+    )[0]
+
+
+@torch.no_grad()
+def generate_stream(
+    model: LLaMA,
+    prompt: torch.Tensor,
+    max_new_tokens: int,
+    *,
+    max_seq_length: Optional[int] = None,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+    prefill_buckets: Optional[Sequence[int]] = None,
+    prefill_chunk_size: Optional[int] = None,
+) -> Iterator[int]:
+    """Like ``generate``, but yields every new token as soon as it is sampled.
+
+    Pair it with ``tokenizer.IncrementalDecoder`` to stream text. Stopping the iteration early stops generation.
+
+    Args:
+        model: The model to use.
+        prompt: Tensor of shape (T) with indices of the prompt sequence.
+        max_new_tokens: The number of new tokens to generate.
+        max_seq_length: The maximum sequence length allowed.
+        temperature: Scales the predicted logits by 1 / temperature
+        top_k: If specified, only sample among the tokens with the k highest probabilities
+        eos_id: If specified, stop after yielding the <eos> token
+        prefill_buckets: If specified, pad the prompt to the smallest of these lengths that fits it
+        prefill_chunk_size: If specified, prefill at most this many tokens per forward pass
     """
-    # create an empty tensor of the expected final shape and fill in the current tokens
     T = prompt.size(0)
-    T_new = T + max_new_tokens
     if max_seq_length is None:
-        max_seq_length = min(T_new, model.config.block_size)
+        max_seq_length = min(T + max_new_tokens, model.config.block_size)
+    max_new_tokens = min(max_new_tokens, max_seq_length - T)
     model.setup_caches(max_batch_size=1, max_seq_length=max_seq_length)
+    sampling_kwargs = dict(temperature=temperature, top_k=top_k)
 
+    next_token = prefill_batch(
+        model, [prompt], [0], prefill_buckets=prefill_buckets, prefill_chunk_size=prefill_chunk_size, **sampling_kwargs
+    )
+    input_pos = torch.tensor([[T]], device=prompt.device)
+    for i in range(max_new_tokens):
+        if i > 0:
+            next_token = decode_one_token(model, input_pos, next_token.view(1, 1), **sampling_kwargs)
+            input_pos = input_pos + 1
+        token = next_token.item()
+        yield token
+        if token == eos_id:
+            return
+
+
+async def generate_stream_async(*args, **kwargs) -> AsyncIterator[int]:
+    """``generate_stream`` as an async iterator. Each token is computed on the default executor so the event loop
+    keeps serving other coroutines meanwhile. Takes the same arguments as ``generate_stream``."""
+    loop = asyncio.get_running_loop()
+    tokens = generate_stream(*args, **kwargs)
+    done = object()
+    while True:
+        token = await loop.run_in_executor(None, next, tokens, done)
+        if token is done:
+            return
+        yield token
+
+
+def speculative_decode(
+    model: LLaMA,
+    draft_model: LLaMA,
+    cur_token: torch.Tensor,
+    input_pos: int,
+    speculate_k: int,
+    **sampling_kwargs
+) -> torch.Tensor:
+    """Proposes ``speculate_k`` tokens with the draft model and verifies them with one target forward.
+
+    Rejection sampling keeps the output distributed exactly as if it had been sampled from the target model alone.
+    Returns the accepted tokens followed by one token sampled from the target, between 1 and ``speculate_k + 1``.
+    """
+    device = cur_token.device
+
+    # draft model proposes k tokens, one cheap forward each
+    draft_tokens, draft_probs = [], []
+    token = cur_token.view(1, 1)
+    for i in range(speculate_k):
+        logits = draft_model(token, torch.tensor([[input_pos + i]], device=device))
+        probs = logits_to_probs(logits[0, -1], **sampling_kwargs)
+        token = fast_multinomial_sample_one(probs).to(dtype=torch.int).view(1, 1)
+        draft_tokens.append(token.view(1))
+        draft_probs.append(probs)
+    draft_tokens = torch.cat(draft_tokens)
+    draft_probs = torch.stack(draft_probs)
+
+    # target model scores the current token and all k proposals in a single forward: [k + 1, V]
+    target_input = torch.cat([cur_token.view(1), draft_tokens]).view(1, -1)
+    target_logits = model(target_input, torch.arange(input_pos, input_pos + speculate_k + 1, device=device))
+    target_probs = logits_to_probs(target_logits[0], **sampling_kwargs)
+
+    # accept draft token i with probability min(1, q(x_i) / p(x_i))
+    idx = torch.arange(speculate_k, device=device)
+    p = draft_probs[idx, draft_tokens]
+    q = target_probs[idx, draft_tokens]
+    accept_draft_prob = torch.clamp(q / p, max=1.0)
+    rejected_locations = (torch.rand_like(accept_draft_prob) > accept_draft_prob).nonzero()
+
+    if rejected_locations.size(0) == 0:
+        # everything accepted: take a bonus token from the target and let the draft cache catch up on the last proposal
+        last_token = fast_multinomial_sample_one(target_probs[-1]).to(dtype=torch.int)
+        draft_model(draft_tokens[-1].view(1, 1), torch.tensor([[input_pos + speculate_k]], device=device))
+        return torch.cat([draft_tokens, last_token])
+
+    # resample the first rejected position from the residual max(0, q - p)
+    accept_length = rejected_locations[0].item()
+    residual = torch.clamp(target_probs[accept_length] - draft_probs[accept_length], min=0)
+    residual = residual / residual.sum()
+    next_token = fast_multinomial_sample_one(residual).to(dtype=torch.int)
+    return torch.cat([draft_tokens[:accept_length], next_token])
+
+@torch.no_grad()
+def speculative_generate(
+    model: LLaMA,
+    draft_model: LLaMA,
+    prompt: torch.Tensor,
+    max_new_tokens: int,
+    *,
+    speculate_k: int = 5,
+    max_seq_length: Optional[int] = None,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    eos_id: Optional[int] = None,
+) -> Tuple[torch.Tensor, Dict[str, Any]]:
+    """Like ``generate``, but decodes with speculative sampling from a small draft model.
+
+    Args:
+        model: The target model, whose output distribution is preserved.
+        draft_model: A smaller model sharing the target's vocabulary.
+        prompt: Tensor of shape (T) with indices of the prompt sequence.
+        max_new_tokens: The number of new tokens to generate.
+        speculate_k: The number of draft tokens proposed per target forward.
+        max_seq_length: The maximum sequence length allowed.
+        temperature: Scales the predicted logits by 1 / temperature
+        top_k: If specified, only sample among the tokens with the k highest probabilities
+        eos_id: If specified, stop generating any more token once the <eos> token is triggered
+
+    Returns:
+        The prompt followed by the generated tokens, and acceptance statistics.
+    """
     device, dtype = prompt.device, prompt.dtype
-    # create an empty tensor of the expected final shape and fill in the current tokens
-    empty = torch.empty(T_new, dtype=dtype, device=device)
-    empty[:T] = prompt
-    seq = empty
+    sampling_kwargs = dict(temperature=temperature, top_k=top_k)
+    T = prompt.size(0)
+    if max_seq_length is None:
+        # verification writes up to speculate_k positions past the last kept token
+        max_seq_length = min(T + max_new_tokens + speculate_k, model.config.block_size, draft_model.config.block_size)
+    max_new_tokens = min(max_new_tokens, max_seq_length - T - speculate_k)
+    T_new = T + max_new_tokens
+    model.setup_caches(max_batch_size=1, max_seq_length=max_seq_length)
+    draft_model.setup_caches(max_batch_size=1, max_seq_length=max_seq_length)
+
+    seq = torch.empty(T_new, dtype=dtype, device=device)
+    seq[:T] = prompt
     input_pos = torch.arange(0, T, device=device)
+    lengths = torch.tensor([T], device=device)
+
+    next_token = prefill(model, input_pos, prompt.view(1, -1), lengths, **sampling_kwargs)
+    prefill(draft_model, input_pos, prompt.view(1, -1), lengths, **sampling_kwargs)
+    seq[T] = next_token[0]
+
+    accept_counts = [0] * (speculate_k + 1)
+    pos = T
+    while pos < T_new - 1:
+        next_tokens = speculative_decode(model, draft_model, next_token, pos, speculate_k, **sampling_kwargs)
+        accept_counts[len(next_tokens) - 1] += 1
+
+        num_added = min(T_new - pos - 1, len(next_tokens))
+        seq[pos + 1 : pos + num_added + 1] = next_tokens[:num_added].to(dtype)
+        if eos_id is not None:
+            eos_hits = (next_tokens[:num_added] == eos_id).nonzero()
+            if eos_hits.size(0) > 0:
+                pos += eos_hits[0].item() + 1
+                break
+        pos += num_added
+        next_token = next_tokens[-1].view(1)
+
+    target_forwards = sum(accept_counts)
+    proposed = target_forwards * speculate_k
+    accepted = sum(i * c for i, c in enumerate(accept_counts))
+    stats = dict(
+        accept_counts=accept_counts,
+        acceptance_rate=accepted / proposed if proposed else 0.0,
+        mean_accepted=accepted / target_forwards if target_forwards else 0.0,
+        tokens_per_target_forward=(pos - T) / target_forwards if target_forwards else 0.0,
+    )
+    return seq[: pos + 1], stats
 
-    next_token = prefill(model, input_pos, prompt.view(1, -1), temperature=temperature, top_k=top_k)
-    seq[T] = next_token
 
-    input_pos = torch.tensor([T], device=device, dtype=input_pos.dtype)
+def load_model(
+    fabric: L.Fabric,
+    checkpoint_path: Path,
+    fake: bool = False,
+    quantize: Optional[str] = None,
+    dtype: Optional[torch.dtype] = None,
+) -> LLaMA:
+    if is_mmap_checkpoint(checkpoint_path):
+        return load_mmap_model(fabric, checkpoint_path, fake, quantize, dtype)
 
-    # generate max_new_tokens tokens
-    for _ in range(max_new_tokens - 1):
-        cur_token = next_token.view(1, -1)
+    t0 = time.perf_counter()
+    with lazy_load(checkpoint_path) as checkpoint:
+        name = llama_model_lookup(checkpoint)
+        t1 = time.perf_counter()
 
-        # forward
-        next_token = decode_one_token(model, input_pos, cur_token, temperature=temperature, top_k=top_k)
+        with fabric.init_module(empty_init=True), quantization(quantize):
+            model = LLaMA.from_name(name, fused_mlp=is_fused_mlp_checkpoint(checkpoint))
+        t2 = time.perf_counter()
 
-        # advance
-        input_pos = input_pos + 1
+        timings = {"index": t1 - t0, "build": t2 - t1}
+        if not fake:
+            timings.update(load_state_dict_parallel(model, checkpoint))
+    print(", ".join(f"{phase} {seconds:.02f}s" for phase, seconds in timings.items()), file=sys.stderr)
+    return model.eval()
 
-        # concatenate the new generation
-        seq[input_pos] = next_token
 
-        # if <eos> token is triggered, return the output (stop generation)
-        if next_token == eos_id:
-            return seq[:input_pos]  # include the EOS token
+def load_mmap_model(
+    fabric: L.Fabric,
+    checkpoint_path: Path,
+    fake: bool = False,
+    quantize: Optional[str] = None,
+    dtype: Optional[torch.dtype] = None,
+) -> LLaMA:
+    """Loads a checkpoint written by ``convert_mmap.py`` without copying its weights.
+
+    The model is built on the meta device and its parameters are assigned the tensors viewing the mapped file, so
+    pages are only read from disk as they are first touched. On a non-CPU device the weights are still copied over.
+    So are they when ``dtype`` differs from the dtype the checkpoint was written in: every floating point tensor is
+    cast to ``dtype``.
+    """
+    with mmap_load(checkpoint_path) as checkpoint:
+        name = llama_model_lookup(checkpoint)
 
-    return seq
+        with torch.device("meta"), quantization(quantize):
+            model = LLaMA.from_name(name, fused_mlp=is_fused_mlp_checkpoint(checkpoint))
+
+        if fake:
+            model.to_empty(device=fabric.device)
+        else:
+            checkpoint_dtype = checkpoint["transformer.wte.weight"].dtype
+            if dtype is not None and dtype != checkpoint_dtype:
+                print(
+                    f"{checkpoint_path} holds {checkpoint_dtype} weights, casting them to {dtype}. Convert it with"
+                    f" --dtype {str(dtype).split('.')[1]} to map it without a copy.",
+                    file=sys.stderr,
+                )
+            model.load_state_dict(checkpoint, assign=True)
+        model.to(device=fabric.device, dtype=dtype)
+    return model.eval()
 
 
 def main(
@@ -146,6 +788,19 @@ def main(
     compile: bool = True,
     profile: Optional[Path] = None,
     max_optimize: bool = True,
+    draft_checkpoint_path: Optional[Path] = None,
+    speculate_k: int = 5,
+    quantize: Optional[str] = None,
+    device: str = "auto",
+    dtype: Optional[str] = None,
+    num_threads: Optional[int] = None,
+    num_interop_threads: Optional[int] = None,
+    numa_node: Optional[int] = None,
+    stream: bool = False,
+    instrument: bool = False,
+    offload_layers: Optional[int] = None,
+    parallel_samples: bool = False,
+    beam_width: Optional[int] = None,
 ) -> None:
     """Generates text samples based on a pre-trained LLaMA model and tokenizer.
 
@@ -159,31 +814,53 @@ def main(
         checkpoint_path: The checkpoint path to load.
         tokenizer_path: The tokenizer path to load.
         quantize: Whether to quantize the model and using which method:
-            ``"llm.int8"``: LLM.int8() mode,
+            ``"int8"``: weight-only int8, the checkpoint must come from ``quantize.py``,
             ``"gptq.int4"``: GPTQ 4-bit mode.
+        draft_checkpoint_path: If specified, decode speculatively with this smaller draft model.
+        speculate_k: The number of draft tokens verified per target forward in speculative mode.
+        device: The device to run on, e.g. ``"cpu"`` or ``"cuda:1"``. ``"auto"`` picks CUDA, then MPS, then CPU.
+        dtype: The weight and KV cache dtype, e.g. ``"bfloat16"``. Defaults to half precision on accelerators and to
+            bfloat16 or float32 on CPUs, depending on native bf16 support.
+        num_threads: On CPU, the intra-op threads. Defaults to the CPUs available to the process.
+        num_interop_threads: On CPU, the inter-op threads.
+        numa_node: On CPU, pin the process to this NUMA node's CPUs.
+        stream: Whether to print the text of every token as soon as it is sampled.
+        instrument: Whether to collect per-component time, FLOPs and bandwidth counters and print them at the end.
+            Runs the model eagerly, the counters are Python hooks.
+        offload_layers: If specified, keep the transformer blocks on disk and stream them in with at most this many
+            in memory at once, see ``offload.py``. Needs an mmap checkpoint from ``convert_mmap.py`` and a CPU device.
+        parallel_samples: Whether to prefill the prompt once and decode all ``num_samples`` samples together as one
+            batch, instead of one after the other.
+        beam_width: If specified, print the single most likely continuation found by a beam search of this width.
     """
     #assert checkpoint_path.is_file(), checkpoint_path
     #assert tokenizer_path.is_file(), tokenizer_path
 
-    precision = "16-true"
-    fabric = L.Fabric(devices=1, precision=precision)
+    device = pick_device(device)
+    if device.type == "cpu":
+        configure_cpu_threads(num_threads, num_interop_threads, numa_node)
+    dtype = pick_dtype(device) if dtype is None else getattr(torch, dtype)
+    precision = {torch.float32: "32-true", torch.float16: "16-true", torch.bfloat16: "bf16-true"}[dtype]
+    fabric = L.Fabric(
+        accelerator=device.type, devices=[device.index] if device.index is not None else 1, precision=precision
+    )
 
     print("Loading model ...", file=sys.stderr)
     t0 = time.time()
-    with lazy_load(checkpoint_path) as checkpoint:
-        name = llama_model_lookup(checkpoint)
-
-        with fabric.init_module(empty_init=True):
-            model = LLaMA.from_name(name)
-            model.to(torch.device("mps"))
-
-        if not fake:
-            model.load_state_dict(checkpoint)
+    streamer = None
+    if offload_layers is not None:
+        assert device.type == "cpu", "Offloading streams the blocks into CPU memory"
+        streamer = load_offloaded_model(checkpoint_path, offload_layers, dtype, quantize)
+        model = streamer.model
+        # the swaps happen in Python hooks around every block
+        compile = False
+    else:
+        model = load_model(fabric, checkpoint_path, fake, quantize, dtype)
+    draft_model = None
+    if draft_checkpoint_path is not None:
+        draft_model = load_model(fabric, draft_checkpoint_path, fake, dtype=dtype)
     print(f"Time to load model: {time.time() - t0:.02f} seconds.", file=sys.stderr)
 
-
-    model.eval()
-
     tokenizer = Tokenizer(tokenizer_path)
     encoded = tokenizer.encode(prompt, bos=True, eos=False, device=fabric.device)
     if prompt_synthetic is not None:
@@ -192,33 +869,113 @@ def main(
 
     L.seed_everything(1234)
     model_size = sum([p.numel() * p.data.element_size() for p in itertools.chain(model.parameters(), model.buffers())])
+    # fixed across samples so the compiled graphs see the same cache shapes every time
+    max_seq_length = min(prompt_length + max_new_tokens, model.config.block_size)
+    prefill_buckets = None
+    counters = None
+    if instrument:
+        counters = Instrumentation(model, sync=device.type != "cpu").attach()
+        compile = False
     if compile:
         global decode_one_token, prefill
         decode_one_token = torch.compile(decode_one_token, mode="reduce-overhead")
 
         if max_optimize:
-            # This seems to have some errors sometimes
-            # prefill = torch.compile(prefill, mode="reduce-overhead")
             torch._inductor.config.coordinate_descent_tuning = True
 
+        if draft_model is None:
+            # CUDA graphs ("reduce-overhead") broke on varying prompt lengths; bucketing bounds the shapes instead so
+            # prefill compiles once per bucket, all of it up front
+            prefill_buckets = PREFILL_BUCKETS
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(prefill_buckets))
+            prefill = torch.compile(prefill, dynamic=False)
+            t0 = time.perf_counter()
+            warmup_prefill(model, max_seq_length, prefill_buckets, dtype=encoded.dtype, temperature=temperature, top_k=top_k)
+            print(f"Time to warm up prefill: {time.perf_counter() - t0:.02f} seconds.", file=sys.stderr)
+
+    if beam_width is not None or parallel_samples:
+        t0 = time.perf_counter()
+        if beam_width is not None:
+            ys = [beam_search(model, encoded, beam_width, max_new_tokens, max_seq_length=max_seq_length)]
+        else:
+            ys = generate_n(
+                model, encoded, num_samples, max_new_tokens, max_seq_length=max_seq_length, temperature=temperature, top_k=top_k
+            )
+        t = time.perf_counter() - t0
+        model.reset_cache()
+        for y in ys:
+            print(tokenizer.decode(y))
+        tokens_generated = sum(y.size(0) - prompt_length for y in ys)
+        print(f"Time for inference: {t:.02f} sec total, {tokens_generated / t:.02f} tokens/sec", file=sys.stderr)
+        # the loop below would sample again
+        num_samples = 0
 
     for i in range(num_samples):
         t0 = time.perf_counter()
         import contextlib
         prof = contextlib.nullcontext() if i != num_samples - 1 or not profile else torch.profiler.profile()
         with prof:
-            y = generate(model, encoded, max_new_tokens, temperature=temperature, top_k=top_k)
+            if draft_model is not None:
+                y, stats = speculative_generate(
+                    model, draft_model, encoded, max_new_tokens, speculate_k=speculate_k, temperature=temperature, top_k=top_k
+                )
+            elif stream:
+                decoder = IncrementalDecoder(tokenizer)
+                print(tokenizer.decode(encoded), end="", flush=True)
+                new_tokens = []
+                for token in generate_stream(
+                    model,
+                    encoded,
+                    max_new_tokens,
+                    max_seq_length=max_seq_length,
+                    temperature=temperature,
+                    top_k=top_k,
+                    prefill_buckets=prefill_buckets,
+                ):
+                    new_tokens.append(token)
+                    print(decoder.add(token), end="", flush=True)
+                print(decoder.flush())
+                y = torch.cat([encoded, torch.tensor(new_tokens, dtype=encoded.dtype, device=encoded.device)])
+            else:
+                y = generate(
+                    model,
+                    encoded,
+                    max_new_tokens,
+                    max_seq_length=max_seq_length,
+                    temperature=temperature,
+                    top_k=top_k,
+                    prefill_buckets=prefill_buckets,
+                )
         if hasattr(prof, "export_chrome_trace"):
             prof.export_chrome_trace(f"{profile}.json")
         t = time.perf_counter() - t0
 
         model.reset_cache()
-        print(tokenizer.decode(y))
+        if not stream or draft_model is not None:
+            print(tokenizer.decode(y))
         tokens_generated = y.size(0) - prompt_length
         tokens_sec = tokens_generated / t
         print(f"Time for inference {i + 1}: {t:.02f} sec total, {tokens_generated / t:.02f} tokens/sec", file=sys.stderr)
         print(f"Bandwidth achieved: {model_size * tokens_sec / 1e9:.02f} GB/s")
         print(f"Memory used: {model_size / 1e9:.02f} GB")
+        if draft_model is not None:
+            print(
+                f"Acceptance rate: {stats['acceptance_rate']:.02%}, mean accepted: {stats['mean_accepted']:.02f},"
+                f" tokens per target forward: {stats['tokens_per_target_forward']:.02f},"
+                f" accept counts: {stats['accept_counts']}",
+                file=sys.stderr,
+            )
+    if streamer is not None:
+        stats = streamer.stats()
+        print(
+            f"Layer prefetch hit rate: {stats['hit_rate']:.02%}, stalled on I/O {stats['stall_seconds']:.02f} s,"
+            f" reading {stats['read_seconds']:.02f} s",
+            file=sys.stderr,
+        )
+        streamer.close()
+    if counters is not None:
+        counters.detach()
+        print(json.dumps(counters.snapshot(), indent=2), file=sys.stderr)
 
 if __name__ == "__main__":
     from jsonargparse import CLI
@@ -229,9 +986,4 @@ if __name__ == "__main__":
         "ignore",
         message="ComplexHalf support is experimental and many operators don't support it yet"
     )
-    warnings.filterwarnings(
-        # Triggered in bitsandbytes/autograd/_functions.py:298
-        "ignore",
-        message="MatMul8bitLt: inputs will be cast from torch.bfloat16 to float16 during quantization",
-    )
     CLI(main)
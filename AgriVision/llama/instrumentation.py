@@ -0,0 +1,224 @@
+"""Lightweight counters for the LLaMA hot path.
+
+``Instrumentation`` hooks ``Block``, ``CausalSelfAttention``, ``MLP`` (or ``FusedMLP``) and ``RMSNorm`` and wraps
+``apply_rope`` and the KV cache ``update`` methods. Every call adds its wall time and an analytic estimate of its FLOPs
+and bytes moved to a per-component counter, from which achieved FLOP/s and bandwidth follow. Nothing is synchronized
+or copied unless ``sync`` is set, so the overhead is a couple of ``perf_counter`` calls per component::
+
+    with Instrumentation(model) as counters:
+        generate(model, prompt, max_new_tokens)
+    print(counters.to_prometheus())
+
+The hooks run in Python, so instrumentation forces eager mode: under ``torch.compile`` every hook is a graph break and
+no CUDA graph can be captured. The counters describe the eager model, which is slower than a compiled one, so use them
+to profile rather than leave them on in production.
+
+``apply_rope`` and the cache ``update`` methods are patched where they are defined, which every model shares. The
+wrappers only count the calls made while one of the instrumented model's attention layers runs, so the work of a draft
+model or any other model in the process is left out.
+"""
+import functools
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+
+import model as llama_model
+from model import LLaMA
+
+# the cache classes whose update() is wrapped
+CACHE_CLASSES = ("KVCache", "QuantizedKVCache", "PagedKVCache", "SinkKVCache")
+
+
+@dataclass
+class Counter:
+    calls: int = 0
+    seconds: float = 0.0
+    flops: float = 0.0
+    bytes: float = 0.0
+
+
+def _tensor_bytes(*values: Any) -> int:
+    total = 0
+    for value in values:
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            total += _tensor_bytes(*value)
+    return total
+
+
+def _state_bytes(module: nn.Module) -> int:
+    return sum(t.numel() * t.element_size() for t in (*module.parameters(), *module.buffers()))
+
+
+def _linear_flops(module: nn.Module, tokens: int) -> int:
+    # 2 FLOPs per multiply-add of every linear (also the quantized ones, which keep in/out_features) per token
+    return sum(
+        2 * tokens * m.in_features * m.out_features for m in module.modules() if hasattr(m, "in_features")
+    )
+
+
+def _attention_flops(x: torch.Tensor, max_seq_length: int) -> int:
+    # q @ k^T and att @ v over the whole cache: 2 * 2 * B * T * S * C
+    B, T, C = x.shape
+    return 4 * B * T * max_seq_length * C
+
+
+def module_cost(module: nn.Module, args: Tuple, output: Any) -> Tuple[int, int]:
+    """Estimated (FLOPs, bytes moved) of one forward of ``module``.
+
+    Bytes count the weights plus the input and output activations; K/V cache traffic is counted by the cache
+    ``update`` wrappers instead.
+    """
+    x = args[0]
+    io_bytes = _tensor_bytes(x, output)
+    if isinstance(module, llama_model.RMSNorm):
+        return 4 * x.numel(), io_bytes + _state_bytes(module)
+    tokens = x.numel() // x.size(-1)
+    flops = _linear_flops(module, tokens)
+    if isinstance(module, llama_model.CausalSelfAttention):
+        flops += _attention_flops(x, args[3])
+    elif isinstance(module, llama_model.Block):
+        flops += _attention_flops(x, args[3]) + 2 * 4 * x.numel()
+    return flops, io_bytes + _state_bytes(module)
+
+
+class Instrumentation:
+    """Aggregated wall time, FLOPs and bytes per LLaMA component.
+
+    Args:
+        model: The model to instrument. Hooks are attached on ``__enter__`` / ``attach`` and removed on ``detach``.
+        per_layer: Whether to also keep counters per module instance (``transformer.h.3.attn``), not only per type.
+        sync: Whether to synchronize the device around every timed call. Needed for exact times on accelerators,
+            where kernels run asynchronously, at the cost of stalling the pipeline.
+    """
+
+    def __init__(self, model: LLaMA, per_layer: bool = False, sync: bool = False) -> None:
+        self.model = model
+        self.per_layer = per_layer
+        self.sync = sync
+        self.counters: Dict[str, Counter] = defaultdict(Counter)
+        self._handles: List[Any] = []
+        self._patched: List[Tuple[Any, str, Callable]] = []
+        self._starts: Dict[int, float] = {}
+        # how many of the model's attention layers are running, the patched functions only count inside them
+        self._active = 0
+
+    def _now(self) -> float:
+        if self.sync:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elif torch.backends.mps.is_available():
+                torch.mps.synchronize()
+        return time.perf_counter()
+
+    def _record(self, names: Tuple[str, ...], seconds: float, flops: int, nbytes: int) -> None:
+        for name in names:
+            counter = self.counters[name]
+            counter.calls += 1
+            counter.seconds += seconds
+            counter.flops += flops
+            counter.bytes += nbytes
+
+    def _hook_module(self, name: str, module: nn.Module) -> None:
+        names = (type(module).__name__, name) if self.per_layer else (type(module).__name__,)
+
+        is_attention = isinstance(module, llama_model.CausalSelfAttention)
+
+        def pre_hook(module, args):
+            self._active += is_attention
+            self._starts[id(module)] = self._now()
+
+        def hook(module, args, output):
+            seconds = self._now() - self._starts.pop(id(module))
+            self._active -= is_attention
+            self._record(names, seconds, *module_cost(module, args, output))
+
+        self._handles.append(module.register_forward_pre_hook(pre_hook))
+        self._handles.append(module.register_forward_hook(hook))
+
+    def _wrap(self, owner: Any, attr: str, name: str, flops_per_element: int) -> None:
+        fn = getattr(owner, attr)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self._active:
+                return fn(*args, **kwargs)
+            t0 = self._now()
+            output = fn(*args, **kwargs)
+            seconds = self._now() - t0
+            tensors = [a for a in args if isinstance(a, torch.Tensor)]
+            flops = flops_per_element * tensors[0].numel() if flops_per_element else 0
+            self._record((name,), seconds, flops, _tensor_bytes(tensors, output))
+            return output
+
+        self._patched.append((owner, attr, fn))
+        setattr(owner, attr, wrapper)
+
+    def attach(self) -> "Instrumentation":
+        hooked = (
+            llama_model.Block,
+            llama_model.CausalSelfAttention,
+            llama_model.MLP,
+            llama_model.FusedMLP,
+            llama_model.RMSNorm,
+        )
+        for name, module in self.model.named_modules():
+            if isinstance(module, hooked):
+                self._hook_module(name, module)
+        # 4 multiplies and 2 adds per rotated pair
+        self._wrap(llama_model, "apply_rope", "apply_rope", 3)
+        for cls_name in CACHE_CLASSES:
+            self._wrap(getattr(llama_model, cls_name), "update", f"{cls_name}.update", 0)
+        return self
+
+    def detach(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self._handles.clear()
+        for owner, attr, fn in reversed(self._patched):
+            setattr(owner, attr, fn)
+        self._patched.clear()
+        self._active = 0
+
+    def __enter__(self) -> "Instrumentation":
+        return self.attach()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.detach()
+
+    def reset(self) -> None:
+        self.counters.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """The counters per component, with the achieved GFLOP/s and GB/s derived from them."""
+        return {
+            name: dict(
+                calls=c.calls,
+                seconds=c.seconds,
+                flops=c.flops,
+                bytes=c.bytes,
+                gflops_per_sec=c.flops / c.seconds / 1e9 if c.seconds else 0.0,
+                gb_per_sec=c.bytes / c.seconds / 1e9 if c.seconds else 0.0,
+            )
+            for name, c in sorted(self.counters.items())
+        }
+
+    def to_prometheus(self, prefix: str = "llama") -> str:
+        """The counters in the Prometheus text exposition format, one labelled series per component."""
+        lines = []
+        for metric, help_text in (
+            ("calls", "Forward calls"),
+            ("seconds", "Wall time spent"),
+            ("flops", "Estimated floating point operations"),
+            ("bytes", "Estimated bytes moved"),
+        ):
+            lines.append(f"# HELP {prefix}_{metric}_total {help_text}.")
+            lines.append(f"# TYPE {prefix}_{metric}_total counter")
+            for name, counter in sorted(self.counters.items()):
+                lines.append(f'{prefix}_{metric}_total{{component="{name}"}} {getattr(counter, metric)}')
+        return "\n".join(lines) + "\n"
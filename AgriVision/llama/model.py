@@ -4,8 +4,9 @@ Based on the nanoGPT implementation: https://github.com/karpathy/nanoGPT.
 """
 # mypy: ignore-errors
 import math
+from collections import deque
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Union
+from typing import Any, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -21,30 +22,6 @@ def find_multiple(n: int, k: int) -> int:
         return n
     return n + k - (n % k)
 
-class LinearInt8(torch.nn.Module):
-    __constants__ = ['in_features', 'out_features']
-    in_features: int
-    out_features: int
-    weight: torch.Tensor
-
-    def __init__(self, in_features: int, out_features: int, bias: bool = True,
-                 device=None, dtype=None) -> None:
-        factory_kwargs = {'device': device, 'dtype': dtype}
-        super().__init__()
-        self.in_features = in_features
-        self.out_features = out_features
-        self.register_buffer("weight", torch.empty((out_features, in_features), dtype=torch.int8))
-        # if bias:
-        #     self.register_buffer("bias", torch.empty(out_features, **factory_kwargs, dtype=torch.int8))
-        # else:
-        #     self.bias('bias', None)
-
-
-    def forward(self, input: torch.Tensor) -> torch.Tensor:
-        return F.linear(input, self.weight.to(dtype=input.dtype))
-
-# nn.Linear = LinearInt8
-
 @dataclass
 class LLaMAConfig:
     block_size: int = 2048
@@ -53,14 +30,30 @@ class LLaMAConfig:
     n_layer: int = 32
     n_head: int = 32
     n_embd: int = 4096
+    # grouped-query attention: query heads share n_kv_head K/V heads, n_head (plain multi-head attention) by default
+    n_kv_head: Optional[int] = None
+    # MLP hidden size, by default 2/3 of 4 * n_embd rounded up to a multiple of 256
+    intermediate_size: Optional[int] = None
+    rope_base: int = 10000
+    # gate and up projections stacked into one c_fc, the layout written by convert_inference.py
+    fused_mlp: bool = False
 
     def __post_init__(self):
         if self.padded_vocab_size is None:
             self.padded_vocab_size = find_multiple(self.vocab_size, 64)
+        if self.n_kv_head is None:
+            self.n_kv_head = self.n_head
+        assert self.n_head % self.n_kv_head == 0, f"{self.n_head} query heads do not split into {self.n_kv_head} groups"
+        if self.intermediate_size is None:
+            self.intermediate_size = find_multiple(int(2 * 4 * self.n_embd / 3), 256)
+
+    @property
+    def head_size(self) -> int:
+        return self.n_embd // self.n_head
 
     @classmethod
-    def from_name(cls, name: str) -> Self:
-        return cls(**llama_configs[name])
+    def from_name(cls, name: str, **kwargs: Any) -> Self:
+        return cls(**{**llama_configs[name], **kwargs})
 
 
 llama_configs = {
@@ -68,38 +61,390 @@ llama_configs = {
     "13B": dict(n_layer=40, n_head=40, n_embd=5120),
     "30B": dict(n_layer=60, n_head=52, n_embd=6656),
     "65B": dict(n_layer=80, n_head=64, n_embd=8192),
+    # small draft model for speculative decoding, shares the 32000 token vocabulary
+    "tiny": dict(n_layer=12, n_head=12, n_embd=768),
+    # grouped-query attention with 8 K/V heads
+    "Llama-2-70B": dict(block_size=4096, n_layer=80, n_head=64, n_embd=8192, n_kv_head=8, intermediate_size=28672),
+    "Llama-3-8B": dict(
+        block_size=8192, vocab_size=128256, n_layer=32, n_head=32, n_embd=4096, n_kv_head=8, intermediate_size=14336,
+        rope_base=500000,
+    ),
+    "Llama-3-70B": dict(
+        block_size=8192, vocab_size=128256, n_layer=80, n_head=64, n_embd=8192, n_kv_head=8, intermediate_size=28672,
+        rope_base=500000,
+    ),
 }
 
 class KVCache(nn.Module):
-    def __init__(self, max_batch_size, max_seq_length, n_heads, head_size, device='mps', dtype=torch.float16):
+    def __init__(self, max_batch_size, max_seq_length, n_heads, head_size, device=None, dtype=None):
         super().__init__()
         cache_shape = (max_batch_size, n_heads, max_seq_length, head_size)
         self.k_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
         self.v_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
 
-    def update(self, input_pos, k_val, v_val):
-        # input_pos: [S], k_val: [B, H, S, D]
-        assert input_pos.shape[0] == k_val.shape[2]
+    def update(self, input_pos, k_val, v_val, slot_idx=None):
+        # input_pos: [S] shared by all rows or [B, S] per row, k_val: [B, H, S, D]
+        # slot_idx: optional [B] cache rows to write to, defaults to the first B rows
+        assert input_pos.shape[-1] == k_val.shape[2]
+        B = k_val.size(0)
+
+        if slot_idx is None and input_pos.dim() == 1:
+            self.k_cache[:B, :, input_pos] = k_val
+            self.v_cache[:B, :, input_pos] = v_val
+            return self.k_cache[:B], self.v_cache[:B]
+
+        # advanced indices around a slice move the indexed dims first: [B, S, H, D]
+        rows = torch.arange(B, device=input_pos.device) if slot_idx is None else slot_idx
+        self.k_cache[rows.view(-1, 1), :, input_pos] = k_val.transpose(1, 2)
+        self.v_cache[rows.view(-1, 1), :, input_pos] = v_val.transpose(1, 2)
+
+        if slot_idx is None:
+            return self.k_cache[:B], self.v_cache[:B]
+        return self.k_cache[slot_idx], self.v_cache[slot_idx]
+
+    def read(self, slot, start, end):
+        # -> k, v: [H, end - start, D]
+        return self.k_cache[slot, :, start:end], self.v_cache[slot, :, start:end]
+
+    def write(self, slot, start, k_val, v_val):
+        # k_val: [H, S, D]
+        end = start + k_val.size(1)
+        self.k_cache[slot, :, start:end] = k_val
+        self.v_cache[slot, :, start:end] = v_val
+
+def quantize_kv(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # symmetric int8 with one scale per head and token: x [..., D] -> int8 [..., D], scales [..., 1]
+    scales = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+    q = torch.round(x.float() / scales).clamp(-127, 127).to(torch.int8)
+    return q, scales.to(x.dtype)
+
+class QuantizedKVCache(nn.Module):
+    def __init__(self, max_batch_size, max_seq_length, n_heads, head_size, device=None, dtype=None):
+        super().__init__()
+        cache_shape = (max_batch_size, n_heads, max_seq_length, head_size)
+        scales_shape = (max_batch_size, n_heads, max_seq_length, 1)
+        self.register_buffer("k_cache", torch.zeros(cache_shape, device=device, dtype=torch.int8))
+        self.register_buffer("v_cache", torch.zeros(cache_shape, device=device, dtype=torch.int8))
+        self.register_buffer("k_scales", torch.ones(scales_shape, device=device, dtype=dtype))
+        self.register_buffer("v_scales", torch.ones(scales_shape, device=device, dtype=dtype))
+
+    def update(self, input_pos, k_val, v_val, slot_idx=None):
+        # same contract as KVCache.update, except that only the positions up to the furthest one written are returned.
+        # K/V are stored as int8 and that prefix is dequantized for attention, a transient full precision copy that is
+        # freed once the layer's attention ran
+        assert input_pos.shape[-1] == k_val.shape[2]
+        B = k_val.size(0)
+
+        rows = torch.arange(B, device=input_pos.device) if slot_idx is None else slot_idx
+        k_q, k_s = quantize_kv(k_val)
+        v_q, v_s = quantize_kv(v_val)
+        for cache, val in ((self.k_cache, k_q), (self.k_scales, k_s), (self.v_cache, v_q), (self.v_scales, v_s)):
+            cache[rows.view(-1, 1), :, input_pos] = val.transpose(1, 2)
+
+        # no query attends past the furthest position written. Slicing there needs its value on the host, a device
+        # sync per layer
+        n = int(input_pos.max()) + 1
+        rows = slice(None, B) if slot_idx is None else slot_idx
+        k, k_s = self.k_cache[rows, :, :n], self.k_scales[rows, :, :n]
+        v, v_s = self.v_cache[rows, :, :n], self.v_scales[rows, :, :n]
+        return k.to(k_val.dtype) * k_s, v.to(v_val.dtype) * v_s
+
+    def read(self, slot, start, end):
+        k = self.k_cache[slot, :, start:end].to(self.k_scales.dtype) * self.k_scales[slot, :, start:end]
+        v = self.v_cache[slot, :, start:end].to(self.v_scales.dtype) * self.v_scales[slot, :, start:end]
+        return k, v
+
+    def write(self, slot, start, k_val, v_val):
+        end = start + k_val.size(1)
+        self.k_cache[slot, :, start:end], self.k_scales[slot, :, start:end] = quantize_kv(k_val)
+        self.v_cache[slot, :, start:end], self.v_scales[slot, :, start:end] = quantize_kv(v_val)
+
+class SinkKVCache(nn.Module):
+    """Constant-size KV cache for streaming: ``n_sink`` attention-sink tokens plus a ring buffer of recent tokens.
+
+    Keys are stored before RoPE. Every step, window positions are shifted down so the oldest cached token sits right
+    after the sinks, and RoPE is applied with those in-cache positions. Rotary positions therefore never exceed
+    ``n_sink + window + T`` however long the stream runs, and distances inside the window stay exact.
+    """
+
+    def __init__(self, max_batch_size, n_sink, window, n_heads, head_size, device=None, dtype=None):
+        super().__init__()
+        cache_shape = (max_batch_size, n_heads, n_sink + window, head_size)
+        self.k_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
+        self.v_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
+        # absolute token position held by each cache entry, -1 when empty
+        self.register_buffer("positions", torch.full((max_batch_size, n_sink + window), -1, device=device, dtype=torch.long))
+        self.n_sink = n_sink
+        self.window = window
+
+    def update(self, input_pos, q, k_val, v_val, rope_cache, slot_idx=None):
+        # input_pos: [T] or [B, T] absolute positions, q, k_val, v_val: [B, T, H, D] before RoPE
+        # returns q: [B, H, T, D], k, v: [B, H, n_sink + window + T, D] and mask: [B, 1, T, n_sink + window + T]
+        B, T = q.size(0), q.size(1)
+        assert T <= self.window, f"Cannot stream {T} tokens at once, the window is only {self.window}"
+
+        rows = torch.arange(B, device=input_pos.device) if slot_idx is None else slot_idx
+        pos = input_pos if input_pos.dim() == 2 else input_pos.expand(B, -1)
+        key_pos = torch.cat([self.positions[rows], pos], dim=1)
+        k = torch.cat([self.k_cache[rows].transpose(1, 2), k_val], dim=1)
+        v = torch.cat([self.v_cache[rows].transpose(1, 2), v_val], dim=1)
+
+        # shift window positions so the oldest one the first query can see lands right after the sinks
+        offset = (pos[:, :1] - self.window - self.n_sink).clamp(min=0)
+        key_rel = torch.where(key_pos < self.n_sink, key_pos, key_pos - offset).clamp(min=0)
+        q = apply_rope(q, rope_cache[pos - offset])
+        k = apply_rope(k, rope_cache[key_rel])
+
+        q_abs, k_abs = pos.unsqueeze(-1), key_pos.unsqueeze(1)
+        mask = (k_abs >= 0) & (k_abs <= q_abs) & ((k_abs < self.n_sink) | (k_abs >= q_abs - self.window))
+
+        # store the new tokens, un-rotated, in their ring slots
+        slots = torch.where(pos < self.n_sink, pos, self.n_sink + (pos - self.n_sink) % self.window)
+        self.k_cache[rows.view(-1, 1), :, slots] = k_val
+        self.v_cache[rows.view(-1, 1), :, slots] = v_val
+        self.positions[rows.view(-1, 1), slots] = pos
+
+        return q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), mask.unsqueeze(1)
+
+    def reset(self, slot):
+        self.positions[slot] = -1
+
+class BlockAllocator:
+    """Free list of fixed-size KV cache blocks, shared by every layer.
+
+    Block 0 is never handed out: unreserved block table entries point at it, so writes for padding or idle rows land
+    in a scratch block that is always masked out.
+    """
+
+    def __init__(self, num_blocks: int) -> None:
+        self.num_blocks = num_blocks
+        self.free_blocks = deque(range(1, num_blocks))
+
+    @property
+    def num_free(self) -> int:
+        return len(self.free_blocks)
 
-        self.k_cache[:, :, input_pos] = k_val
-        self.v_cache[:, :, input_pos] = v_val
+    def allocate(self, n: int) -> List[int]:
+        if n > len(self.free_blocks):
+            raise RuntimeError(f"Out of KV cache blocks: requested {n}, only {len(self.free_blocks)} free")
+        return [self.free_blocks.popleft() for _ in range(n)]
 
-        return self.k_cache, self.v_cache
+    def free(self, blocks: List[int]) -> None:
+        self.free_blocks.extend(blocks)
+
+class PagedKVCache(nn.Module):
+    def __init__(self, num_blocks, page_size, n_heads, head_size, block_tables, device=None, dtype=None):
+        super().__init__()
+        cache_shape = (num_blocks, n_heads, page_size, head_size)
+        self.k_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
+        self.v_cache = torch.nn.Parameter(torch.zeros(cache_shape, device=device, dtype=dtype))
+        self.page_size = page_size
+        # [max_batch_size, max_blocks_per_seq], owned by the KVCacheAggregator and shared by all layers
+        self.block_tables = block_tables
+        # block table columns attention reads, the most blocks any slot holds; kept up to date by the aggregator
+        self.live_blocks = block_tables.size(1)
+
+    def update(self, input_pos, k_val, v_val, slot_idx=None):
+        # input_pos: [S] or [B, S], k_val: [B, H, S, D], slot_idx: optional [B] block table rows
+        assert input_pos.shape[-1] == k_val.shape[2]
+        B = k_val.size(0)
+
+        rows = torch.arange(B, device=input_pos.device) if slot_idx is None else slot_idx
+        tables = self.block_tables[rows]
+        pos = input_pos if input_pos.dim() == 2 else input_pos.expand(B, -1)
+        blocks = tables.gather(1, pos // self.page_size)
+        offsets = pos % self.page_size
+        self.k_cache[blocks, :, offsets] = k_val.transpose(1, 2)
+        self.v_cache[blocks, :, offsets] = v_val.transpose(1, 2)
+
+        # gather each row's blocks back into a dense [B, H, live_blocks * page_size, D] view for attention, only as
+        # long as the longest reserved slot rather than max_seq_length
+        tables = tables[:, : self.live_blocks]
+        k = self.k_cache[tables].transpose(1, 2).flatten(2, 3)
+        v = self.v_cache[tables].transpose(1, 2).flatten(2, 3)
+        return k, v
+
+    def _locate(self, slot, start, end):
+        pos = torch.arange(start, end, device=self.block_tables.device)
+        return self.block_tables[slot, pos // self.page_size], pos % self.page_size
+
+    def read(self, slot, start, end):
+        # -> k, v: [H, end - start, D]
+        blocks, offsets = self._locate(slot, start, end)
+        return self.k_cache[blocks, :, offsets].transpose(0, 1), self.v_cache[blocks, :, offsets].transpose(0, 1)
+
+    def write(self, slot, start, k_val, v_val):
+        # k_val: [H, S, D]
+        blocks, offsets = self._locate(slot, start, start + k_val.size(1))
+        self.k_cache[blocks, :, offsets] = k_val.transpose(0, 1)
+        self.v_cache[blocks, :, offsets] = v_val.transpose(0, 1)
 
 class KVCacheAggregator(nn.Module):
     def __init__(self):
         super().__init__()
         self.kv_caches = nn.ModuleList([])
+        self.max_seq_length = None
+        self.page_size = None
+        self.attention_sinks = None
+        self.allocator: Optional[BlockAllocator] = None
+        self.block_tables: Optional[torch.Tensor] = None
+        self.slot_blocks: List[List[int]] = []
+        # what the current caches were allocated for, everything but the batch size has to match to reuse them
+        self.cache_key: Optional[tuple] = None
+        self.max_batch_size = 0
+
+    def initialize(self,layers, max_batch_size, max_seq_length, n_heads, head_size, device=None, dtype=None, page_size=None, num_blocks=None, quantize=False, attention_sinks=None):
+        """Allocates the per-layer caches, or resets and reuses the current ones if they were allocated for the same
+        configuration with at least ``max_batch_size`` rows."""
+        key = (layers, max_seq_length, n_heads, head_size, torch.device(device), dtype, page_size, num_blocks, quantize, attention_sinks)
+        if key == self.cache_key and max_batch_size <= self.max_batch_size:
+            self.reset()
+            return
+        self.clear()
+        self._allocate(layers, max_batch_size, max_seq_length, n_heads, head_size, device, dtype, page_size, num_blocks, quantize, attention_sinks)
+        self.cache_key = key
+        self.max_batch_size = max_batch_size
 
-    def initialize(self,layers, max_batch_size, max_seq_length, n_heads, head_size, device='mps', dtype=torch.float16):
-        cache_shape = (max_batch_size, n_heads, max_seq_length, head_size)
-        self.kv_caches = nn.ModuleList([KVCache(max_batch_size, max_seq_length, n_heads, head_size) for _ in range(layers)])
+    def _allocate(self, layers, max_batch_size, max_seq_length, n_heads, head_size, device, dtype, page_size, num_blocks, quantize, attention_sinks):
+        self.max_seq_length = max_seq_length
+        self.page_size = page_size
+        self.attention_sinks = attention_sinks
+        if quantize and page_size is not None:
+            raise ValueError("Quantized KV caches cannot be paged")
+        if attention_sinks is not None:
+            if quantize or page_size is not None:
+                raise ValueError("Streaming KV caches cannot be quantized or paged")
+            self.allocator = None
+            self.block_tables = None
+            window = max_seq_length - attention_sinks
+            self.kv_caches = nn.ModuleList(
+                [SinkKVCache(max_batch_size, attention_sinks, window, n_heads, head_size, device=device, dtype=dtype) for _ in range(layers)]
+            )
+            return
+        if page_size is None:
+            self.allocator = None
+            self.block_tables = None
+            if quantize:
+                self.kv_caches = nn.ModuleList(
+                    [QuantizedKVCache(max_batch_size, max_seq_length, n_heads, head_size, device=device, dtype=dtype) for _ in range(layers)]
+                )
+            else:
+                self.kv_caches = nn.ModuleList(
+                    [KVCache(max_batch_size, max_seq_length, n_heads, head_size, device=device, dtype=dtype) for _ in range(layers)]
+                )
+            return
+
+        assert max_seq_length % page_size == 0, f"max seq length {max_seq_length} is not a multiple of page size {page_size}"
+        max_blocks_per_seq = max_seq_length // page_size
+        if num_blocks is None:
+            # as many blocks as the dense layout, plus the scratch block
+            num_blocks = max_batch_size * max_blocks_per_seq + 1
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables = torch.zeros((max_batch_size, max_blocks_per_seq), device=device, dtype=torch.long)
+        self.slot_blocks = [[] for _ in range(max_batch_size)]
+        self.kv_caches = nn.ModuleList(
+            [PagedKVCache(num_blocks, page_size, n_heads, head_size, self.block_tables, device=device, dtype=dtype) for _ in range(layers)]
+        )
+        self._update_live_blocks()
+
+    def _update_live_blocks(self) -> None:
+        # paged attention only gathers as many blocks per row as the longest slot holds, at least one
+        live_blocks = max(1, max(map(len, self.slot_blocks), default=0))
+        for kv_cache in self.kv_caches:
+            kv_cache.live_blocks = live_blocks
+
+    @property
+    def streaming(self) -> bool:
+        return self.attention_sinks is not None
+
+    def can_reserve(self, num_tokens: int, slot: Optional[int] = None) -> bool:
+        if self.streaming:
+            return True
+        if num_tokens > self.max_seq_length:
+            return False
+        if self.allocator is None:
+            return True
+        have = len(self.slot_blocks[slot]) if slot is not None else 0
+        return -(-num_tokens // self.page_size) - have <= self.allocator.num_free
+
+    def reserve(self, slot: int, num_tokens: int) -> None:
+        """Makes sure positions ``[0, num_tokens)`` of ``slot`` are backed by cache memory."""
+        if self.streaming:
+            return
+        if num_tokens > self.max_seq_length:
+            raise ValueError(f"Cannot reserve {num_tokens} tokens, max seq length is only {self.max_seq_length}")
+        if self.allocator is None:
+            return
+        blocks = self.slot_blocks[slot]
+        need = -(-num_tokens // self.page_size)
+        if need <= len(blocks):
+            return
+        new_blocks = self.allocator.allocate(need - len(blocks))
+        self.block_tables[slot, len(blocks):need] = torch.tensor(new_blocks, device=self.block_tables.device, dtype=torch.long)
+        blocks.extend(new_blocks)
+        self._update_live_blocks()
+
+    def release(self, slot: int) -> None:
+        """Returns the blocks of ``slot`` to the free list."""
+        if self.streaming:
+            for kv_cache in self.kv_caches:
+                kv_cache.reset(slot)
+            return
+        if self.allocator is None:
+            return
+        self.allocator.free(self.slot_blocks[slot])
+        self.slot_blocks[slot] = []
+        self.block_tables[slot] = 0
+        self._update_live_blocks()
+
+    def copy_rows(self, src: torch.Tensor, dst: torch.Tensor) -> None:
+        """Sets the cached K/V of slots ``dst`` to those of slots ``src``, in every layer.
+
+        ``src`` may repeat or permute slots, the rows are gathered before they are written. This forks one prefilled
+        prompt into several rows, and reorders beams with ``copy_rows(beam_idx, arange(n))``.
+        """
+        if self.allocator is not None:
+            # paged: copy block contents between the slots' own blocks, dst has to be reserved at least as far as src
+            src_blocks, dst_blocks = [], []
+            for s, d in zip(src.tolist(), dst.tolist()):
+                n = len(self.slot_blocks[s])
+                assert len(self.slot_blocks[d]) >= n, f"slot {d} holds fewer blocks than slot {s}"
+                src_blocks += self.slot_blocks[s]
+                dst_blocks += self.slot_blocks[d][:n]
+            src = torch.tensor(src_blocks, device=self.block_tables.device, dtype=torch.long)
+            dst = torch.tensor(dst_blocks, device=self.block_tables.device, dtype=torch.long)
+        for kv_cache in self.kv_caches:
+            # every per-slot tensor of a cache (K/V, int8 scales, sink positions) has the slot (or block) first
+            for tensor in (*kv_cache.parameters(recurse=False), *kv_cache.buffers(recurse=False)):
+                tensor.data[dst] = tensor.data[src]
 
     def __getitem__(self, idx):
         return self.kv_caches[idx]
 
+    def reset(self):
+        """Releases every slot while keeping the cache memory allocated.
+
+        Dense rows need no clearing: prefill and decode write every position before the mask lets a query attend to it,
+        so the K/V a previous request left behind are never read.
+        """
+        if self.streaming:
+            for kv_cache in self.kv_caches:
+                kv_cache.positions.fill_(-1)
+        elif self.allocator is not None:
+            self.allocator = BlockAllocator(self.allocator.num_blocks)
+            self.block_tables.zero_()
+            self.slot_blocks = [[] for _ in self.slot_blocks]
+            self._update_live_blocks()
+
     def clear(self):
+        """Frees the cache memory."""
         self.kv_caches = nn.ParameterList([])
+        self.attention_sinks = None
+        self.allocator = None
+        self.block_tables = None
+        self.slot_blocks = []
+        self.cache_key = None
+        self.max_batch_size = 0
 
 class LLaMA(nn.Module):
     def __init__(self, config: LLaMAConfig) -> None:
@@ -117,26 +462,65 @@ class LLaMA(nn.Module):
         )
 
         self.rope_cache: Optional[RoPECache] = None
-        self.mask_cache: Optional[MaskCache] = None
+        self.rope_cache_key: Optional[tuple] = None
         self.kv_caches = KVCacheAggregator()
         self.max_batch_size = None
         self.max_seq_length = None
 
-    def setup_caches(self, max_batch_size, max_seq_length, device='mps', dtype=torch.float16):
-        head_size = self.config.n_embd // self.config.n_head
-
+    def setup_caches(self, max_batch_size, max_seq_length, device=None, dtype=None, page_size=None, num_blocks=None, quantize_kv_cache=False, attention_sinks=None):
+        """Allocates the KV caches, or reuses the ones from the previous call if they fit.
+
+        Caches persist across calls and ``reset_cache``: a call with the same length, dtype, device and cache options
+        and at most as many rows as before only resets them. The causal mask is not cached, it is computed from the
+        positions in every forward pass.
+
+        With ``page_size`` set, K/V live in a pool of ``num_blocks`` fixed-size blocks that sequences reserve on demand
+        through ``kv_caches.reserve`` / ``kv_caches.release`` instead of one dense worst-case row each. The default
+        ``num_blocks`` matches the dense layout, so the pool only saves memory with ``num_blocks`` set below
+        ``max_batch_size * max_seq_length / page_size + 1``. Attention gathers each row's blocks up to the longest
+        reserved slot, a transient copy per layer of that length rather than ``max_seq_length``.
+        With ``quantize_kv_cache`` set, K/V are stored as int8 with a scale per head and token, halving cache memory.
+        Attention dequantizes one layer at a time, and only up to the furthest position written, so the transient
+        full precision copy grows with the sequence rather than being a whole dense layer. Finding that position costs
+        a device sync per layer, which also breaks CUDA graphs under ``torch.compile``.
+        With ``attention_sinks`` set, the caches keep that many initial tokens plus a rolling window of the most recent
+        ``max_seq_length - attention_sinks`` tokens, and the model accepts positions past ``block_size``.
+        ``device`` and ``dtype`` default to those of the model's weights.
+        """
+        head_size = self.config.head_size
+        weight = self.transformer.wte.weight
+        device = weight.device if device is None else device
+        dtype = weight.dtype if dtype is None else dtype
+
+        if page_size is not None:
+            assert self.config.block_size % page_size == 0, f"page size {page_size} must divide block size {self.config.block_size}"
+            max_seq_length = find_multiple(max_seq_length, page_size)
         self.max_seq_length = max_seq_length
         self.max_batch_size = max_batch_size
-        self.kv_caches.initialize(layers=self.config.n_layer, max_batch_size=max_batch_size, max_seq_length=max_seq_length, n_heads=self.config.n_head, head_size=head_size)
-
-        self.rope_cache = build_rope_cache(
-            seq_len=self.config.block_size,
-            n_elem=self.config.n_embd // self.config.n_head,
-            dtype=dtype,
+        self.kv_caches.initialize(
+            layers=self.config.n_layer,
+            max_batch_size=max_batch_size,
+            max_seq_length=max_seq_length,
+            # read off the attention rather than the config, tensor parallel ranks only hold some of the heads
+            n_heads=self.transformer.h[0].attn.n_kv_head,
+            head_size=head_size,
             device=device,
+            dtype=dtype,
+            page_size=page_size,
+            num_blocks=num_blocks,
+            quantize=quantize_kv_cache,
+            attention_sinks=attention_sinks,
         )
-        ones = torch.ones((self.config.block_size, self.config.block_size), device=device, dtype=torch.bool)
-        self.mask_cache = torch.tril(ones).unsqueeze(0).unsqueeze(0)
+
+        if self.rope_cache_key != (torch.device(device), dtype):
+            self.rope_cache = build_rope_cache(
+                seq_len=self.config.block_size,
+                n_elem=head_size,
+                dtype=dtype,
+                device=device,
+                base=self.config.rope_base,
+            )
+            self.rope_cache_key = (torch.device(device), dtype)
 
     def _init_weights(self, module: nn.Module) -> None:
         if isinstance(module, nn.Linear):
@@ -145,8 +529,17 @@ class LLaMA(nn.Module):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02 / math.sqrt(2 * self.config.n_layer))
 
     def forward(
-        self, idx: torch.Tensor, input_pos: Optional[torch.Tensor] = None
+        self,
+        idx: torch.Tensor,
+        input_pos: Optional[torch.Tensor] = None,
+        slot_idx: Optional[torch.Tensor] = None,
+        logits_idx: Optional[torch.Tensor] = None,
     ) -> Union[torch.Tensor, Tuple[torch.Tensor, List[KVCache]]]:
+        """Runs the model over ``idx`` (B, T) at cache positions ``input_pos``.
+
+        With ``logits_idx`` (B), only the logits of that position of every row are computed and returned as
+        (B, 1, vocab_size), instead of (B, T, vocab_size) for every position.
+        """
         B, T = idx.size()
 
         block_size = self.config.block_size
@@ -158,15 +551,29 @@ class LLaMA(nn.Module):
         assert max_seq_length <= block_size, f"Cannot attend to {max_seq_length}, block size is only {block_size}"
         assert T <= block_size, f"Cannot forward sequence of length {T}, block size is only {block_size}"
 
-        rope = self.rope_cache.index_select(0, input_pos)
-        mask = self.mask_cache.index_select(2, input_pos)
-        mask = mask[:, :, :, :max_seq_length]
+        if self.kv_caches.streaming:
+            # positions are unbounded, the caches re-base them into the window and build their own masks
+            assert max_seq_length + T <= block_size, f"Cannot stream {T} tokens over a {max_seq_length} token cache, block size is only {block_size}"
+            rope, mask = self.rope_cache, None
+        else:
+            # a query at position p attends to cache positions <= p, (T, max_seq_length) or (B, T, max_seq_length)
+            mask = torch.arange(max_seq_length, device=input_pos.device) <= input_pos.unsqueeze(-1)
+            if input_pos.dim() == 1:
+                rope = self.rope_cache.index_select(0, input_pos)
+                mask = mask.view(1, 1, T, max_seq_length)
+            else:
+                # per-row positions: rope (B, T, hs / 2, 2), mask (B, 1, T, max_seq_length)
+                rope = self.rope_cache[input_pos]
+                mask = mask.unsqueeze(1)
 
         # forward the model itself
         x = self.transformer.wte(idx)  # token embeddings of shape (b, t, n_embd)
 
         for i, block in enumerate(self.transformer.h):
-            x, new_kv_cache = block(x, rope, mask, max_seq_length, input_pos, self.kv_caches[i])
+            x, new_kv_cache = block(x, rope, mask, max_seq_length, input_pos, self.kv_caches[i], slot_idx)
+
+        if logits_idx is not None:
+            x = x[torch.arange(B, device=x.device), logits_idx].unsqueeze(1)  # (b, 1, n_embd)
 
         x = self.transformer.ln_f(x)
 
@@ -175,10 +582,15 @@ class LLaMA(nn.Module):
         return logits
 
     @classmethod
-    def from_name(cls, name: str) -> Self:
-        return cls(LLaMAConfig.from_name(name))
+    def from_name(cls, name: str, **kwargs: Any) -> Self:
+        return cls(LLaMAConfig.from_name(name, **kwargs))
 
     def reset_cache(self) -> None:
+        """Releases every cache slot, keeping the memory for the next ``setup_caches``."""
+        self.kv_caches.reset()
+
+    def release_caches(self) -> None:
+        """Frees the KV cache memory."""
         self.kv_caches.clear()
 
 
@@ -188,7 +600,7 @@ class Block(nn.Module):
         self.rms_1 = RMSNorm(config.n_embd)
         self.attn = CausalSelfAttention(config)
         self.rms_2 = RMSNorm(config.n_embd)
-        self.mlp = MLP(config)
+        self.mlp = FusedMLP(config) if config.fused_mlp else MLP(config)
 
     def forward(
         self,
@@ -198,8 +610,9 @@ class Block(nn.Module):
         max_seq_length: int,
         input_pos: Optional[torch.Tensor] = None,
         kv_cache: Optional[KVCache] = None,
+        slot_idx: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, Optional[KVCache]]:
-        h, new_kv_cache = self.attn(self.rms_1(x), rope, mask, max_seq_length, input_pos, kv_cache)
+        h, new_kv_cache = self.attn(self.rms_1(x), rope, mask, max_seq_length, input_pos, kv_cache, slot_idx)
         x = x + h
         x = x + self.mlp(self.rms_2(x))
         return x, new_kv_cache
@@ -210,13 +623,16 @@ class CausalSelfAttention(nn.Module):
         super().__init__()
         assert config.n_embd % config.n_head == 0
 
-        # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=False)
+        # query projections for all heads and key, value projections for the n_kv_head K/V heads, but in a batch
+        self.kv_size = config.n_kv_head * config.head_size
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_size, bias=False)
         # output projection
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=False)
 
         self.n_head = config.n_head
+        self.n_kv_head = config.n_kv_head
         self.n_embd = config.n_embd
+        self.head_size = config.head_size
         self.block_size = config.block_size
 
     def forward(
@@ -227,26 +643,33 @@ class CausalSelfAttention(nn.Module):
         max_seq_length: int,
         input_pos: Optional[torch.Tensor] = None,
         kv_cache: Optional[KVCache] = None,
+        slot_idx: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, Optional[KVCache]]:
         B, T, C = x.size()  # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        q, k, v = self.c_attn(x).split(self.n_embd, dim=2)
+        q, k, v = self.c_attn(x).split([self.n_embd, self.kv_size, self.kv_size], dim=2)
 
-        head_size = C // self.n_head
-        k = k.view(B, T, self.n_head, head_size)
+        head_size = self.head_size
+        k = k.view(B, T, self.n_kv_head, head_size)
         q = q.view(B, T, self.n_head, head_size)
-        v = v.view(B, T, self.n_head, head_size)
+        v = v.view(B, T, self.n_kv_head, head_size)
 
-        q = apply_rope(q, rope)
-        k = apply_rope(k, rope)
+        if isinstance(kv_cache, SinkKVCache):
+            # streaming caches apply RoPE themselves, with positions re-based into the window
+            q, k, v, mask = kv_cache.update(input_pos, q, k, v, rope, slot_idx)
+        else:
+            q = apply_rope(q, rope)
+            k = apply_rope(k, rope)
 
-        k = k.transpose(1, 2)  # (B, nh, T, hs)
-        q = q.transpose(1, 2)  # (B, nh, T, hs)
-        v = v.transpose(1, 2)  # (B, nh, T, hs)
+            k = k.transpose(1, 2)  # (B, nh, T, hs)
+            q = q.transpose(1, 2)  # (B, nh, T, hs)
+            v = v.transpose(1, 2)  # (B, nh, T, hs)
 
-        if kv_cache is not None:
-            k, v = kv_cache.update(input_pos, k, v)
+            if kv_cache is not None:
+                k, v = kv_cache.update(input_pos, k, v, slot_idx)
+                # paged and quantized caches return only the positions in use, fewer than max_seq_length
+                mask = mask[..., : k.size(-2)]
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         #  att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
@@ -256,9 +679,17 @@ class CausalSelfAttention(nn.Module):
 
         # efficient attention using Flash Attention CUDA kernels
         # y = F.scaled_dot_product_attention(q, k, v)
+        if self.n_kv_head != self.n_head:
+            # query head h uses K/V head h // group. Folding each group of query heads into the query length lets
+            # K/V broadcast against them instead of being repeated: (B, n_kv_head, group * T, hs)
+            group = self.n_head // self.n_kv_head
+            q = q.reshape(B, self.n_kv_head, group * T, head_size)
+            if mask is not None:
+                mask = mask.unsqueeze(2).expand(-1, -1, group, -1, -1).reshape(mask.size(0), 1, group * T, -1)
         y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
+        y = y.view(B, self.n_head, T, head_size)
 
-        y = y.transpose(1, 2).contiguous().view(B, T, C)  # re-assemble all head outputs side by side
+        y = y.transpose(1, 2).contiguous().view(B, T, self.n_embd)  # re-assemble all head outputs side by side
 
         # output projection
         y = self.c_proj(y)
@@ -269,9 +700,7 @@ class CausalSelfAttention(nn.Module):
 class MLP(nn.Module):
     def __init__(self, config: LLaMAConfig) -> None:
         super().__init__()
-        hidden_dim = 4 * config.n_embd
-        n_hidden = int(2 * hidden_dim / 3)
-        n_hidden = find_multiple(n_hidden, 256)
+        n_hidden = config.intermediate_size
 
         self.c_fc1 = nn.Linear(config.n_embd, n_hidden, bias=False)
         self.c_fc2 = nn.Linear(config.n_embd, n_hidden, bias=False)
@@ -283,6 +712,25 @@ class MLP(nn.Module):
         return x
 
 
+class FusedMLP(nn.Module):
+    """``MLP`` with ``c_fc1`` and ``c_fc2`` stacked into one projection, so the input is read by a single GEMM.
+
+    ``c_fc.weight`` is ``cat([c_fc1.weight, c_fc2.weight])``, see ``convert_inference.py``.
+    """
+
+    def __init__(self, config: LLaMAConfig) -> None:
+        super().__init__()
+        n_hidden = config.intermediate_size
+
+        self.c_fc = nn.Linear(config.n_embd, 2 * n_hidden, bias=False)
+        self.c_proj = nn.Linear(n_hidden, config.n_embd, bias=False)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        gate, up = self.c_fc(x).chunk(2, dim=-1)
+        x = self.c_proj(F.silu(gate) * up)
+        return x
+
+
 class RMSNorm(nn.Module):
     """Root Mean Square Layer Normalization.
 
@@ -335,11 +783,14 @@ def build_rope_cache(
 def apply_rope(x: torch.Tensor, rope_cache: RoPECache) -> torch.Tensor:
     # truncate to support variable sizes
     T = x.size(1)
-    rope_cache = rope_cache[:T]
 
     # cast because the reference does
     xshaped = x.float().reshape(*x.shape[:-1], -1, 2)
-    rope_cache = rope_cache.view(1, xshaped.size(1), 1, xshaped.size(3), 2)
+    if rope_cache.dim() == 4:
+        # per-row positions, (B, T, hs / 2, 2)
+        rope_cache = rope_cache[:, :T].view(xshaped.size(0), T, 1, xshaped.size(3), 2)
+    else:
+        rope_cache = rope_cache[:T].view(1, T, 1, xshaped.size(3), 2)
     x_out2 = torch.stack(
         [
             xshaped[..., 0] * rope_cache[..., 0] - xshaped[..., 1] * rope_cache[..., 1],
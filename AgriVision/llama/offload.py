@@ -0,0 +1,148 @@
+"""Runs LLaMA with its transformer blocks streamed from disk, for models larger than RAM.
+
+The block weights stay in a memory-mapped checkpoint written by ``convert_mmap.py``. Only the embeddings, the final
+norm and ``lm_head`` are kept in memory; a block is copied in right before its forward and dropped right after. While
+block ``i`` computes, a background thread reads the next ones, so with fast enough storage the model never waits on
+I/O. At most ``max_resident_layers`` blocks are in memory or being read at any time.
+"""
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+
+from model import LLaMA
+from utils import is_fused_mlp_checkpoint, llama_model_lookup, mmap_load, quantization
+
+
+class LayerStreamer:
+    """Swaps the blocks of ``model`` in and out of memory around their forward passes.
+
+    Args:
+        model: A model whose blocks are on the meta device.
+        checkpoint: The mapped checkpoint the block weights are read from. It has to stay open while streaming.
+        max_resident_layers: The most blocks held in memory, counting the ones being prefetched. 1 disables
+            prefetching; 2 or more overlaps reading the next block(s) with computing the current one.
+        dtype: If specified, floating point weights are cast to it as they are read.
+    """
+
+    def __init__(
+        self, model: LLaMA, checkpoint: mmap_load, max_resident_layers: int = 2, dtype: Optional[torch.dtype] = None
+    ) -> None:
+        assert max_resident_layers >= 1
+        self.model = model
+        self.checkpoint = checkpoint
+        self.blocks: List[nn.Module] = list(model.transformer.h)
+        self.max_resident_layers = min(max_resident_layers, len(self.blocks))
+        self.dtype = dtype
+        self.executor = ThreadPoolExecutor(1)
+        # block index -> weights read in the background, not yet assigned
+        self.pending: "OrderedDict[int, Future]" = OrderedDict()
+        self.resident = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.stall_seconds = 0.0
+        self.read_seconds = 0.0
+        self._handles = []
+        for i, block in enumerate(self.blocks):
+            self._handles.append(block.register_forward_pre_hook(self._make_pre_hook(i)))
+            self._handles.append(block.register_forward_hook(self._make_hook(i)))
+
+    def _read(self, i: int) -> Dict[str, torch.Tensor]:
+        t0 = time.perf_counter()
+        prefix = f"transformer.h.{i}."
+        names = [name for name in self.checkpoint.sd if name.startswith(prefix)]
+        weights = {}
+        for name in names:
+            tensor = self.checkpoint.sd[name]
+            dtype = self.dtype if self.dtype is not None and tensor.dtype.is_floating_point else tensor.dtype
+            weights[name[len(prefix):]] = tensor.to(dtype=dtype, copy=True)
+        # the copies are private now, keep the mapped pages from piling up in the resident set
+        self.checkpoint.evict(names)
+        self.read_seconds += time.perf_counter() - t0
+        return weights
+
+    def _prefetch(self, i: int) -> None:
+        if i in self.resident or i in self.pending:
+            return
+        if len(self.resident) + len(self.pending) >= self.max_resident_layers:
+            return
+        self.pending[i] = self.executor.submit(self._read, i)
+
+    def _make_pre_hook(self, i: int):
+        def pre_hook(block, args):
+            if i not in self.resident:
+                future = self.pending.pop(i, None)
+                if future is not None and future.done():
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    if future is None:
+                        future = self.executor.submit(self._read, i)
+                t0 = time.perf_counter()
+                weights = future.result()
+                self.stall_seconds += time.perf_counter() - t0
+                block.load_state_dict(weights, assign=True)
+                self.resident.add(i)
+            # the next forward pass starts over at block 0, so look ahead cyclically
+            for j in range(1, self.max_resident_layers):
+                self._prefetch((i + j) % len(self.blocks))
+
+        return pre_hook
+
+    def _make_hook(self, i: int):
+        def hook(block, args, output):
+            if len(self.blocks) > self.max_resident_layers:
+                block.to_empty(device="meta")
+                self.resident.discard(i)
+                self._prefetch((i + self.max_resident_layers) % len(self.blocks))
+
+        return hook
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hit_rate,
+            stall_seconds=self.stall_seconds,
+            read_seconds=self.read_seconds,
+        )
+
+    def close(self) -> None:
+        for handle in self._handles:
+            handle.remove()
+        self.executor.shutdown(wait=True)
+
+
+def load_offloaded_model(
+    checkpoint_path: Path,
+    max_resident_layers: int = 2,
+    dtype: Optional[torch.dtype] = None,
+    quantize: Optional[str] = None,
+) -> LayerStreamer:
+    """Loads everything but the transformer blocks of an mmap checkpoint and streams the blocks from it.
+
+    Returns the streamer, whose ``model`` is ready to generate with.
+    """
+    checkpoint = mmap_load(checkpoint_path)
+    name = llama_model_lookup(checkpoint.sd)
+    with torch.device("meta"), quantization(quantize):
+        model = LLaMA.from_name(name, fused_mlp=is_fused_mlp_checkpoint(checkpoint.sd))
+
+    resident = {}
+    for key, tensor in checkpoint.sd.items():
+        if not key.startswith("transformer.h."):
+            tensor_dtype = dtype if dtype is not None and tensor.dtype.is_floating_point else tensor.dtype
+            resident[key] = tensor.to(dtype=tensor_dtype, copy=True)
+    model.load_state_dict(resident, strict=False, assign=True)
+
+    return LayerStreamer(model.eval(), checkpoint, max_resident_layers, dtype)
@@ -0,0 +1,108 @@
+"""Reuse of computed prompt K/V across generate calls for prompts sharing a token prefix."""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import torch
+
+from model import LLaMA
+
+
+@dataclass
+class PrefixBlock:
+    parent: Optional[int]
+    tokens: Tuple[int, ...]
+    # per layer (k, v), each [H, chunk_size, D]
+    kv: List[Tuple[torch.Tensor, torch.Tensor]]
+    nbytes: int
+
+
+class PrefixCache:
+    """LRU cache of prompt K/V blocks, keyed by a hash of the token prefix they complete.
+
+    Prompts are split into chunks of ``chunk_size`` tokens. The key of a chunk hashes its tokens together with the key
+    of the chunk before it, so finding chunk ``i`` means the whole prefix up to and including it matched.
+
+    A chunk is only reachable through the chunks before it, so every use marks a prompt's chunks as recently used from
+    the last one back to the first. A chunk is then always evicted before the chunks it extends, never leaving behind
+    extensions that ``load`` can no longer reach.
+
+    Args:
+        chunk_size: The number of tokens per cached block. Only full chunks are cached.
+        max_bytes: The memory budget for cached K/V. Least recently used blocks are evicted beyond it.
+    """
+
+    def __init__(self, chunk_size: int = 64, max_bytes: int = 1 << 30) -> None:
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.blocks: "OrderedDict[int, PrefixBlock]" = OrderedDict()
+        self.nbytes = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+
+    def _chunks(self, tokens: Sequence[int]) -> Iterator[Tuple[int, Optional[int], Tuple[int, ...]]]:
+        parent = None
+        for start in range(0, len(tokens) - self.chunk_size + 1, self.chunk_size):
+            chunk = tuple(tokens[start : start + self.chunk_size])
+            key = hash((parent, chunk))
+            yield key, parent, chunk
+            parent = key
+
+    def load(self, model: LLaMA, slot: int, tokens: Sequence[int]) -> int:
+        """Copies the K/V of the longest cached prefix of ``tokens`` into cache row ``slot``.
+
+        Returns the number of prefix tokens restored. The last prompt token is never restored because prefill has to
+        run over at least one token to produce the logits to sample from.
+        """
+        matched = 0
+        keys = []
+        for key, parent, chunk in self._chunks(tokens[: len(tokens) - 1]):
+            block = self.blocks.get(key)
+            if block is None or block.parent != parent or block.tokens != chunk:
+                break
+            keys.append(key)
+            for layer, (k, v) in zip(model.kv_caches.kv_caches, block.kv):
+                layer.write(slot, matched, k, v)
+            matched += len(chunk)
+        self._touch(keys)
+
+        self.hit_tokens += matched
+        self.miss_tokens += len(tokens) - matched
+        return matched
+
+    def store(self, model: LLaMA, slot: int, tokens: Sequence[int]) -> None:
+        """Caches the full chunks of ``tokens`` whose K/V have just been prefilled into cache row ``slot``."""
+        start = 0
+        keys = []
+        for key, parent, chunk in self._chunks(tokens):
+            keys.append(key)
+            if key not in self.blocks:
+                kv = []
+                for layer in model.kv_caches.kv_caches:
+                    k, v = layer.read(slot, start, start + len(chunk))
+                    kv.append((k.clone(), v.clone()))
+                nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+                self.blocks[key] = PrefixBlock(parent, chunk, kv, nbytes)
+                self.nbytes += nbytes
+            start += len(chunk)
+        self._touch(keys)
+        self._evict()
+
+    def _touch(self, keys: List[int]) -> None:
+        # most recently used last, so the first chunk of the prefix ends up more recent than all its extensions
+        for key in reversed(keys):
+            self.blocks.move_to_end(key)
+
+    def _evict(self) -> None:
+        while self.nbytes > self.max_bytes and self.blocks:
+            _, block = self.blocks.popitem(last=False)
+            self.nbytes -= block.nbytes
+
+    def clear(self) -> None:
+        self.blocks.clear()
+        self.nbytes = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hit_tokens + self.miss_tokens
+        return self.hit_tokens / total if total else 0.0
@@ -0,0 +1,155 @@
+"""Weight-only quantized drop-in replacements for ``torch.nn.Linear``.
+
+The layers keep the ``nn.Linear`` constructor signature so ``utils.quantization`` and ``utils.EmptyInitOnDevice`` can
+swap them in while the model is built. Their quantized weights are buffers that ``load_state_dict`` fills from a
+checkpoint written by ``quantize.py``.
+"""
+from typing import Dict, Tuple
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+# columns sharing one scale / zero point in ``gptq.int4`` checkpoints
+INT4_GROUP_SIZE = 128
+
+
+def quantize_int8_per_channel(weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization of a ``[out, in]`` weight with one scale per output channel.
+
+    Returns the int8 weight and the ``[out]`` scales in the weight's dtype.
+    """
+    w = weight.float()
+    scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127
+    q = torch.round(w / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scales.to(weight.dtype)
+
+
+def quantize_groupwise(weight: torch.Tensor, bits: int, group_size: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Asymmetric round-to-nearest quantization of a ``[out, in]`` weight in groups of ``group_size`` columns.
+
+    ``weight ~= (q - zeros) * scales`` per group. 4-bit values are packed two per byte, the even column in the low
+    nibble. Returns the packed ``uint8`` weight and the ``[out, in / group_size]`` scales and zero points.
+    """
+    out_features, in_features = weight.shape
+    if group_size == -1:
+        group_size = in_features
+    assert in_features % group_size == 0, f"{in_features} columns do not split into groups of {group_size}"
+
+    w = weight.float().view(out_features, in_features // group_size, group_size)
+    max_q = 2**bits - 1
+    w_min = w.amin(dim=-1).clamp(max=0)
+    w_max = w.amax(dim=-1).clamp(min=0)
+    scales = ((w_max - w_min) / max_q).clamp(min=1e-8)
+    zeros = torch.round(-w_min / scales)
+    q = torch.clamp(torch.round(w / scales[..., None]) + zeros[..., None], 0, max_q).to(torch.uint8)
+    q = q.view(out_features, in_features)
+    if bits == 4:
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return q, scales.to(weight.dtype), zeros.to(weight.dtype)
+
+
+def quantize_weight(weight: torch.Tensor, mode: str) -> Dict[str, torch.Tensor]:
+    """Quantizes a linear weight for ``mode``, returning the buffers of the matching quantized layer by name."""
+    if mode == "int8":
+        q, scales = quantize_int8_per_channel(weight)
+        return {"weight": q, "scales": scales}
+    if mode in ("gptq.int4", "gptq.int8"):
+        bits = 4 if mode == "gptq.int4" else 8
+        q, scales, zeros = quantize_groupwise(weight, bits, INT4_GROUP_SIZE if bits == 4 else -1)
+        return {"quant_weight": q, "scales": scales, "zeros": zeros}
+    raise ValueError(f"Unknown quantization mode: {mode}")
+
+
+class LinearInt8(nn.Module):
+    __constants__ = ['in_features', 'out_features']
+    in_features: int
+    out_features: int
+    weight: torch.Tensor
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True,
+                 device=None, dtype=None, tile_rows: int = 1024) -> None:
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.tile_rows = tile_rows
+        self.register_buffer("weight", torch.empty((out_features, in_features), device=device, dtype=torch.int8))
+        self.register_buffer("scales", torch.empty(out_features, device=device, dtype=dtype))
+        if bias:
+            self.register_buffer("bias", torch.empty(out_features, device=device, dtype=dtype))
+        else:
+            self.register_buffer("bias", None)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        # dequantize a tile of output channels at a time so the full float weight is never materialized;
+        # the per-channel scale factors out of the dot product and is applied once to the output
+        outputs = [
+            F.linear(input, self.weight[start : start + self.tile_rows].to(dtype=input.dtype))
+            for start in range(0, self.out_features, self.tile_rows)
+        ]
+        y = torch.cat(outputs, dim=-1) * self.scales.to(dtype=input.dtype)
+        if self.bias is not None:
+            y = y + self.bias.to(dtype=input.dtype)
+        return y
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class ColBlockQuantizedLinear(nn.Module):
+    """Linear layer with ``bits``-bit weights quantized in blocks of ``tile_cols`` columns.
+
+    Every block of every output row has its own scale and zero point. ``tile_cols=-1`` uses one block per row.
+    """
+
+    __constants__ = ['in_features', 'out_features']
+    in_features: int
+    out_features: int
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, device=None, dtype=None,
+                 *, bits: int, tile_cols: int, tile_rows: int = 1024) -> None:
+        super().__init__()
+        assert bits in (4, 8), f"{bits}-bit weights are not supported"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.tile_cols = in_features if tile_cols == -1 else tile_cols
+        self.tile_rows = tile_rows
+        assert in_features % self.tile_cols == 0, f"{in_features} columns do not split into blocks of {self.tile_cols}"
+        n_tiles = in_features // self.tile_cols
+        packed_cols = in_features // 2 if bits == 4 else in_features
+        self.register_buffer("quant_weight", torch.empty((out_features, packed_cols), device=device, dtype=torch.uint8))
+        self.register_buffer("scales", torch.empty((out_features, n_tiles), device=device, dtype=dtype))
+        self.register_buffer("zeros", torch.empty((out_features, n_tiles), device=device, dtype=dtype))
+        if bias:
+            self.register_buffer("bias", torch.empty(out_features, device=device, dtype=dtype))
+        else:
+            self.register_buffer("bias", None)
+
+    def dequantize(self, start: int, end: int, dtype: torch.dtype) -> torch.Tensor:
+        """Float weights of output rows ``[start, end)``."""
+        q = self.quant_weight[start:end]
+        rows = q.size(0)
+        if self.bits == 4:
+            q = torch.stack([q & 0x0F, q >> 4], dim=-1).view(rows, self.in_features)
+        q = q.to(dtype=dtype).view(rows, -1, self.tile_cols)
+        scales = self.scales[start:end, :, None].to(dtype=dtype)
+        zeros = self.zeros[start:end, :, None].to(dtype=dtype)
+        return ((q - zeros) * scales).view(rows, self.in_features)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        # as in LinearInt8, only one tile of output rows is ever held in floating point
+        outputs = [
+            F.linear(input, self.dequantize(start, start + self.tile_rows, input.dtype))
+            for start in range(0, self.out_features, self.tile_rows)
+        ]
+        y = torch.cat(outputs, dim=-1)
+        if self.bias is not None:
+            y = y + self.bias.to(dtype=input.dtype)
+        return y
+
+    def extra_repr(self) -> str:
+        return (
+            f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits},"
+            f" tile_cols={self.tile_cols}, bias={self.bias is not None}"
+        )
@@ -0,0 +1,146 @@
+"""Writes a weight-only quantized copy of a lit-llama checkpoint and compares it against half precision.
+
+Tensors are streamed one at a time from ``lazy_load`` into ``incremental_save``, so the full precision checkpoint
+never has to fit in memory. Load the result with ``generate.py --quantize <mode>``.
+
+Modes:
+    ``"int8"``: per-output-channel int8 weights.
+    ``"gptq.int4"``: 4-bit weights in groups of ``quantization.INT4_GROUP_SIZE`` columns with scales and zero points.
+    ``"gptq.int8"``: 8-bit weights with one scale and zero point per row.
+"""
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import torch
+from torch.nn import functional as F
+
+from quantization import ColBlockQuantizedLinear, LinearInt8, quantize_weight
+from utils import NotYetLoadedTensor, incremental_save, lazy_load
+
+
+def is_linear_weight(name: str, tensor) -> bool:
+    """Whether ``name`` is the weight of an ``nn.Linear`` that the quantized model replaces."""
+    return name.endswith(".weight") and len(tensor.shape) == 2 and name != "transformer.wte.weight"
+
+
+def quantized_linear(weight: torch.Tensor, mode: str) -> torch.nn.Module:
+    """Builds the quantized layer for ``mode`` from a float weight."""
+    out_features, in_features = weight.shape
+    buffers = quantize_weight(weight, mode)
+    if mode == "int8":
+        layer = LinearInt8(in_features, out_features, bias=False, device=weight.device, dtype=weight.dtype)
+    else:
+        layer = ColBlockQuantizedLinear(
+            in_features,
+            out_features,
+            bias=False,
+            device=weight.device,
+            dtype=weight.dtype,
+            bits=4 if mode == "gptq.int4" else 8,
+            tile_cols=in_features // buffers["scales"].size(1),
+        )
+    layer.load_state_dict(buffers)
+    return layer
+
+
+@torch.no_grad()
+def convert(checkpoint_path: Path, output_path: Path, mode: str = "int8") -> None:
+    """Quantizes every linear weight of a checkpoint.
+
+    Args:
+        checkpoint_path: The lit-llama checkpoint to quantize.
+        output_path: Where to write the quantized checkpoint.
+        mode: The quantization mode, see the module docstring.
+    """
+    with lazy_load(checkpoint_path) as checkpoint, incremental_save(output_path) as saver:
+        state_dict = {}
+        for name, tensor in checkpoint.items():
+            if isinstance(tensor, NotYetLoadedTensor):
+                tensor = tensor._load_tensor()
+            if is_linear_weight(name, tensor):
+                prefix = name[: -len("weight")]
+                for buffer_name, buffer in quantize_weight(tensor, mode).items():
+                    state_dict[prefix + buffer_name] = saver.store_early(buffer)
+            else:
+                state_dict[name] = saver.store_early(tensor)
+        saver.save(state_dict)
+
+
+def _time(fn, iters: int) -> float:
+    fn()
+    times = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+@torch.no_grad()
+def compare(
+    checkpoint_path: Path,
+    mode: str = "gptq.int4",
+    tokens: int = 1,
+    iters: int = 10,
+    max_tensors: Optional[int] = None,
+    device: str = "cpu",
+) -> None:
+    """Compares quantized linear layers of a checkpoint against their float16 originals.
+
+    For every linear weight, reports the relative output error on random activations, the median forward latency of
+    both versions and their weight memory.
+
+    Args:
+        checkpoint_path: The lit-llama checkpoint to read.
+        mode: The quantization mode to evaluate.
+        tokens: The number of rows in the random activations, 1 matches decoding.
+        iters: The number of timed forwards per layer.
+        max_tensors: If specified, only compare this many linear weights.
+        device: The device to run on.
+    """
+    dtype = torch.float16
+    total_ref_bytes = total_q_bytes = total_ref_time = total_q_time = 0.0
+    errors = []
+    with lazy_load(checkpoint_path) as checkpoint:
+        names = [name for name, tensor in checkpoint.items() if is_linear_weight(name, tensor)]
+        for name in names[:max_tensors]:
+            weight = checkpoint[name]._load_tensor().to(device=device, dtype=dtype)
+            layer = quantized_linear(weight, mode)
+            x = torch.randn(tokens, weight.size(1), device=device, dtype=dtype)
+
+            y_ref = F.linear(x, weight)
+            y_q = layer(x)
+            error = ((y_q.float() - y_ref.float()).norm() / y_ref.float().norm()).item()
+            ref_time = _time(lambda: F.linear(x, weight), iters)
+            q_time = _time(lambda: layer(x), iters)
+            ref_bytes = weight.numel() * weight.element_size()
+            q_bytes = sum(b.numel() * b.element_size() for b in layer.buffers())
+
+            errors.append(error)
+            total_ref_bytes += ref_bytes
+            total_q_bytes += q_bytes
+            total_ref_time += ref_time
+            total_q_time += q_time
+            print(
+                f"{name}: rel error {error:.04f}, fp16 {ref_time * 1e3:.03f} ms, {mode} {q_time * 1e3:.03f} ms,"
+                f" {ref_bytes / 1e6:.01f} MB -> {q_bytes / 1e6:.01f} MB"
+            )
+
+    if not errors:
+        print("No linear weights found", file=sys.stderr)
+        return
+    print(
+        f"Mean rel error {statistics.mean(errors):.04f} (max {max(errors):.04f}),"
+        f" time {total_ref_time * 1e3:.02f} ms -> {total_q_time * 1e3:.02f} ms"
+        f" ({total_ref_time / total_q_time:.02f}x), memory {total_ref_bytes / 1e9:.02f} GB ->"
+        f" {total_q_bytes / 1e9:.02f} GB ({total_ref_bytes / total_q_bytes:.02f}x)"
+    )
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI([convert, compare])
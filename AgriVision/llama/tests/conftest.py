@@ -0,0 +1,34 @@
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+# the modules import each other by file name, as when run as scripts
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve()))
+
+from model import LLaMA, LLaMAConfig
+
+
+def tiny_config(**kwargs) -> LLaMAConfig:
+    return LLaMAConfig(**{**dict(block_size=64, vocab_size=100, n_layer=2, n_head=4, n_embd=32), **kwargs})
+
+
+@pytest.fixture
+def tiny_model() -> LLaMA:
+    torch.manual_seed(0)
+    model = LLaMA(tiny_config())
+    model.apply(model._init_weights)
+    return model.eval()
+
+
+@torch.no_grad()
+def greedy_reference(model: LLaMA, prompt: torch.Tensor, max_new_tokens: int) -> torch.Tensor:
+    """Greedy continuation recomputing the whole sequence every step, so no cached K/V is ever reused."""
+    seq = prompt
+    for _ in range(max_new_tokens):
+        model.setup_caches(max_batch_size=1, max_seq_length=model.config.block_size)
+        logits = model(seq.view(1, -1), torch.arange(seq.size(0)))
+        seq = torch.cat([seq, logits[0, -1].argmax().view(1).to(seq.dtype)])
+    model.reset_cache()
+    return seq
@@ -0,0 +1,24 @@
+import torch
+
+from benchmark import build_model, measure_case, run_case
+
+
+def test_run_case_reports_metrics():
+    device = torch.device("cpu")
+    model = build_model("nano", device, torch.float32)
+
+    result = run_case(model, batch_size=2, prompt_length=8, new_tokens=4, device=device)
+
+    assert set(result) == {"ttft_ms", "decode_mean_ms", "decode_p50_ms", "decode_p99_ms", "decode_tokens_per_sec"}
+    assert all(value > 0 for value in result.values())
+    assert result["decode_p50_ms"] <= result["decode_p99_ms"]
+
+
+def test_measure_case_adds_peak_rss():
+    result = measure_case(
+        "nano", "float32", batch_size=1, prompt_length=8, new_tokens=3, warmup=0, repeats=2,
+        device=torch.device("cpu"), num_threads=None, seed=1234,
+    )
+
+    assert result["peak_rss_mb"] > 0
+    assert result["decode_p50_ms"] <= result["decode_p99_ms"]
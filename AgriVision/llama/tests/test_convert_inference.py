@@ -0,0 +1,52 @@
+import pytest
+import torch
+from conftest import tiny_config
+
+from convert_inference import convert
+from model import FusedMLP, LLaMA
+from quantize import convert as quantize_checkpoint
+from utils import is_fused_mlp_checkpoint, lazy_load, load_state_dict_parallel, mmap_load, quantization
+
+
+@torch.no_grad()
+def test_fused_checkpoint_matches_original(tiny_model, tmp_path):
+    torch.save(tiny_model.state_dict(), tmp_path / "lit-llama.pth")
+
+    convert(tmp_path / "lit-llama.pth", tmp_path / "lit-llama.inference", dtype="float32")
+    checkpoint = mmap_load(tmp_path / "lit-llama.inference")
+    assert is_fused_mlp_checkpoint(checkpoint.sd)
+    assert not is_fused_mlp_checkpoint(tiny_model.state_dict())
+    with torch.device("meta"):
+        model = LLaMA(tiny_config(fused_mlp=True))
+    model.load_state_dict(checkpoint.sd, assign=True)
+    assert isinstance(model.transformer.h[0].mlp, FusedMLP)
+
+    x = torch.randint(100, (2, 6))
+    model.setup_caches(max_batch_size=2, max_seq_length=8)
+    tiny_model.setup_caches(max_batch_size=2, max_seq_length=8)
+    torch.testing.assert_close(model.eval()(x, torch.arange(6)), tiny_model(x, torch.arange(6)))
+
+
+@pytest.mark.parametrize("mode", ["int8", "gptq.int4"])
+@torch.no_grad()
+def test_quantized_checkpoint_stays_quantized(tmp_path, mode):
+    torch.manual_seed(0)
+    # wide enough for 128-column int4 groups
+    config = tiny_config(n_embd=128)
+    torch.save(LLaMA(config).state_dict(), tmp_path / "lit-llama.pth")
+    quantize_checkpoint(tmp_path / "lit-llama.pth", tmp_path / "quantized.pth", mode)
+
+    convert(tmp_path / "quantized.pth", tmp_path / "quantized.inference", dtype="float32")
+    with torch.device("meta"), quantization(mode):
+        model = LLaMA(tiny_config(n_embd=128, fused_mlp=True))
+    model.load_state_dict(mmap_load(tmp_path / "quantized.inference").sd, assign=True)
+    with quantization(mode):
+        unfused = LLaMA(config)
+    with lazy_load(tmp_path / "quantized.pth") as checkpoint:
+        load_state_dict_parallel(unfused, checkpoint)
+
+    x = torch.randint(100, (1, 6))
+    model.setup_caches(max_batch_size=1, max_seq_length=8)
+    unfused.setup_caches(max_batch_size=1, max_seq_length=8)
+    # stacking the quantized rows changes nothing about how they dequantize
+    torch.testing.assert_close(model.eval()(x, torch.arange(6)), unfused.eval()(x, torch.arange(6)))
@@ -0,0 +1,32 @@
+import pytest
+import torch
+from conftest import greedy_reference
+
+from engine import ContinuousBatchingEngine
+
+
+@pytest.mark.parametrize(
+    "options", [dict(), dict(page_size=8, num_blocks=9), dict(prefill_chunk_size=4)], ids=["dense", "paged", "chunked"]
+)
+def test_engine_matches_reference(tiny_model, options):
+    generator = torch.Generator().manual_seed(10)
+    prompts = [torch.randint(100, (n,), generator=generator, dtype=torch.int) for n in (6, 3, 10)]
+    # three requests on two slots, so the last one is admitted into a slot another request left
+    engine = ContinuousBatchingEngine(tiny_model, 2, 24, top_k=1, **options)
+    requests = [engine.add_request(prompt, 7) for prompt in prompts]
+
+    finished = list(engine.run())
+
+    assert sorted(r.request_id for r in finished) == [0, 1, 2]
+    for prompt, request in zip(prompts, requests):
+        torch.testing.assert_close(request.output, greedy_reference(tiny_model, prompt, 7))
+
+
+def test_engine_rejects_invalid_requests(tiny_model):
+    engine = ContinuousBatchingEngine(tiny_model, 1, 8)
+
+    with pytest.raises(ValueError, match="does not fit"):
+        engine.add_request(torch.zeros(5, dtype=torch.int), 4)
+    with pytest.raises(ValueError, match="at least 1"):
+        engine.add_request(torch.zeros(5, dtype=torch.int), 0)
+    assert not engine.has_pending
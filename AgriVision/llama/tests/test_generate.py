@@ -0,0 +1,115 @@
+import copy
+
+import torch
+from conftest import greedy_reference, tiny_config
+
+from generate import (
+    PREFILL_BUCKETS,
+    beam_search,
+    generate,
+    generate_batch,
+    generate_n,
+    generate_stream,
+    speculative_generate,
+    warmup_prefill,
+)
+from model import LLaMA
+
+
+def test_generate_matches_reference(tiny_model):
+    prompt = torch.randint(100, (7,), generator=torch.Generator().manual_seed(1), dtype=torch.int)
+    expected = greedy_reference(tiny_model, prompt, 12)
+
+    y = generate(tiny_model, prompt, 12, top_k=1)
+    streamed = torch.tensor(list(generate_stream(tiny_model, prompt, 12, top_k=1)), dtype=prompt.dtype)
+
+    torch.testing.assert_close(y, expected)
+    torch.testing.assert_close(streamed, expected[prompt.size(0):])
+    # the reused caches do not change the next call
+    torch.testing.assert_close(generate(tiny_model, prompt, 12, top_k=1), expected)
+
+
+def test_generate_batch_matches_reference(tiny_model):
+    generator = torch.Generator().manual_seed(2)
+    prompts = [torch.randint(100, (n,), generator=generator, dtype=torch.int) for n in (3, 9, 5)]
+
+    ys = generate_batch(tiny_model, prompts, 8, top_k=1)
+
+    for prompt, y in zip(prompts, ys):
+        torch.testing.assert_close(y, greedy_reference(tiny_model, prompt, 8))
+
+
+def test_speculative_generate_matches_reference(tiny_model):
+    prompt = torch.randint(100, (5,), generator=torch.Generator().manual_seed(12), dtype=torch.int)
+    expected = greedy_reference(tiny_model, prompt, 10)
+    torch.manual_seed(1)
+    draft_model = LLaMA(tiny_config(n_layer=1)).eval()
+
+    y, stats = speculative_generate(tiny_model, draft_model, prompt, 10, speculate_k=3, top_k=1)
+    y_self, stats_self = speculative_generate(tiny_model, copy.deepcopy(tiny_model), prompt, 10, speculate_k=3, top_k=1)
+
+    # greedy verification keeps the target's own tokens whatever the draft proposes
+    torch.testing.assert_close(y, expected)
+    torch.testing.assert_close(y_self, expected)
+    assert stats_self["acceptance_rate"] == 1.0
+
+
+def test_attention_sinks(tiny_model):
+    prompt = torch.randint(100, (5,), generator=torch.Generator().manual_seed(13), dtype=torch.int)
+
+    # everything fits in the window, so nothing is evicted yet
+    (y,) = generate_batch(tiny_model, [prompt], 8, max_seq_length=16, attention_sinks=4, top_k=1)
+    # streams well past block_size
+    (long,) = generate_batch(tiny_model, [prompt], 100, attention_sinks=4, top_k=1)
+
+    torch.testing.assert_close(y, greedy_reference(tiny_model, prompt, 8))
+    assert long.size(0) == 105 > tiny_model.config.block_size
+
+
+def test_warmup_prefill_short_cache(tiny_model):
+    prompt = torch.randint(100, (4,), generator=torch.Generator().manual_seed(3), dtype=torch.int)
+
+    # every bucket but the first is past the 11 token cache
+    warmup_prefill(tiny_model, 11, PREFILL_BUCKETS, top_k=1)
+    y = generate(tiny_model, prompt, 7, max_seq_length=11, top_k=1, prefill_buckets=PREFILL_BUCKETS)
+
+    torch.testing.assert_close(y, greedy_reference(tiny_model, prompt, 7))
+
+
+def test_chunked_prefill_matches_reference(tiny_model):
+    generator = torch.Generator().manual_seed(14)
+    prompts = [torch.randint(100, (n,), generator=generator, dtype=torch.int) for n in (10, 4)]
+
+    ys = generate_batch(tiny_model, prompts, 6, top_k=1, prefill_chunk_size=3)
+
+    for prompt, y in zip(prompts, ys):
+        torch.testing.assert_close(y, greedy_reference(tiny_model, prompt, 6))
+
+
+def test_generate_batch_eos_matches_stream(tiny_model):
+    generator = torch.Generator().manual_seed(4)
+    prompts = [torch.randint(100, (n,), generator=generator, dtype=torch.int) for n in (6, 2)]
+    # stop the first row after its third new token
+    eos_id = int(greedy_reference(tiny_model, prompts[0], 3)[-1])
+
+    ys = generate_batch(tiny_model, prompts, 10, top_k=1, eos_id=eos_id, sync_every=4)
+
+    for prompt, y in zip(prompts, ys):
+        streamed = list(generate_stream(tiny_model, prompt, 10, top_k=1, eos_id=eos_id))
+        assert y[prompt.size(0):].tolist() == streamed
+    assert ys[0][-1] == eos_id
+
+
+def test_generate_n_matches_beam_search(tiny_model):
+    prompt = torch.randint(100, (5,), generator=torch.Generator().manual_seed(5), dtype=torch.int)
+    expected = greedy_reference(tiny_model, prompt, 9)
+
+    (y,) = generate_n(tiny_model, prompt, 1, 9, top_k=1)
+    beam = beam_search(tiny_model, prompt, 1, 9)
+    # greedy samples forked from the shared prefill all follow the same path
+    ys = generate_n(tiny_model, prompt, 3, 9, top_k=1)
+
+    torch.testing.assert_close(y, expected)
+    torch.testing.assert_close(beam, expected)
+    for y in ys:
+        torch.testing.assert_close(y, expected)
@@ -0,0 +1,33 @@
+import torch
+from conftest import tiny_config
+
+import model as llama_model
+from generate import generate
+from instrumentation import Instrumentation
+from model import LLaMA
+
+
+def test_instrumentation_counts_components(tiny_model):
+    apply_rope = llama_model.apply_rope
+    prompt = torch.randint(100, (5,), generator=torch.Generator().manual_seed(15), dtype=torch.int)
+    draft_model = LLaMA(tiny_config(n_layer=1)).eval()
+
+    with Instrumentation(tiny_model, per_layer=True) as counters:
+        generate(tiny_model, prompt, 4, top_k=1)
+        # shares apply_rope and the cache classes, but is not counted
+        generate(draft_model, prompt, 4, top_k=1)
+
+    snapshot = counters.snapshot()
+    # one prefill and three decode steps through both blocks
+    assert snapshot["Block"]["calls"] == 4 * 2
+    assert snapshot["transformer.h.0.mlp"]["calls"] == 4
+    for name in ("Block", "CausalSelfAttention", "MLP", "RMSNorm", "apply_rope", "KVCache.update"):
+        assert snapshot[name]["seconds"] > 0
+    # q and k rotated, one cache update, per attention forward
+    assert snapshot["apply_rope"]["calls"] == 2 * 4 * 2
+    assert snapshot["KVCache.update"]["calls"] == 4 * 2
+    assert snapshot["MLP"]["flops"] > 0 and snapshot["MLP"]["bytes"] > 0
+    assert 'llama_calls_total{component="Block"} 8' in counters.to_prometheus()
+    # detaching restores the unwrapped functions
+    assert llama_model.apply_rope is apply_rope
+    assert not tiny_model.transformer.h[0]._forward_hooks
@@ -0,0 +1,96 @@
+import copy
+
+import pytest
+import torch
+from conftest import greedy_reference, tiny_config
+
+from generate import generate, generate_batch
+from model import BlockAllocator, KVCache, LLaMA, QuantizedKVCache
+
+
+def test_paged_cache_matches_reference(tiny_model):
+    generator = torch.Generator().manual_seed(8)
+    prompts = [torch.randint(100, (n,), generator=generator, dtype=torch.int) for n in (5, 11)]
+
+    ys = generate_batch(tiny_model, prompts, 6, max_seq_length=32, page_size=8, top_k=1)
+
+    for prompt, y in zip(prompts, ys):
+        torch.testing.assert_close(y, greedy_reference(tiny_model, prompt, 6))
+
+
+def test_paged_cache_gathers_only_reserved_blocks(tiny_model):
+    tiny_model.setup_caches(max_batch_size=2, max_seq_length=32, page_size=8, num_blocks=4)
+    kv_caches = tiny_model.kv_caches
+
+    kv_caches.reserve(0, 5)
+    kv_caches.reserve(1, 12)
+    with torch.no_grad():
+        k, v = kv_caches[0].update(torch.tensor([0]), torch.zeros(2, 4, 1, 8), torch.zeros(2, 4, 1, 8))
+    assert k.shape == v.shape == (2, 4, 16, 8)
+
+    kv_caches.release(1)
+    assert kv_caches[0].live_blocks == 1
+    assert kv_caches.allocator.num_free == 2
+
+
+def test_block_allocator():
+    allocator = BlockAllocator(4)
+
+    blocks = allocator.allocate(2)
+    # block 0 is the scratch block and never handed out
+    assert 0 not in blocks and allocator.num_free == 1
+    with pytest.raises(RuntimeError, match="Out of KV cache blocks"):
+        allocator.allocate(2)
+    allocator.free(blocks)
+    assert allocator.num_free == 3
+
+
+@torch.no_grad()
+def test_quantized_cache_close_to_dense():
+    torch.manual_seed(9)
+    k, v = torch.randn(2, 4, 6, 8), torch.randn(2, 4, 6, 8)
+    dense, quantized = KVCache(2, 16, 4, 8), QuantizedKVCache(2, 16, 4, 8)
+
+    k_dense, v_dense = dense.update(torch.arange(6), k, v)
+    k_quantized, v_quantized = quantized.update(torch.arange(6), k, v)
+
+    # only the written positions come back, within half a quantization step of the largest value per head and token
+    assert k_quantized.shape == v_quantized.shape == (2, 4, 6, 8)
+    torch.testing.assert_close(k_quantized, k_dense[:, :, :6], atol=k.abs().max() / 254, rtol=0)
+    torch.testing.assert_close(v_quantized, v_dense[:, :, :6], atol=v.abs().max() / 254, rtol=0)
+
+
+def test_reused_caches_do_not_leak_between_requests(tiny_model):
+    generator = torch.Generator().manual_seed(6)
+    first = torch.randint(100, (12,), generator=generator, dtype=torch.int)
+    second = torch.randint(100, (4,), generator=generator, dtype=torch.int)
+    fresh = copy.deepcopy(tiny_model)
+
+    generate(tiny_model, first, 8, max_seq_length=24, top_k=1)
+    tiny_model.reset_cache()
+    # same cache shape, so the caches holding the first request's K/V are reused
+    y = generate(tiny_model, second, 8, max_seq_length=24, top_k=1)
+
+    torch.testing.assert_close(y, generate(fresh, second, 8, max_seq_length=24, top_k=1))
+    torch.testing.assert_close(y, greedy_reference(tiny_model, second, 8))
+
+
+@torch.no_grad()
+def test_grouped_query_attention_matches_repeated_heads():
+    torch.manual_seed(16)
+    gqa = LLaMA(tiny_config(n_kv_head=2)).eval()
+    mha = LLaMA(tiny_config()).eval()
+    # the same model with every K/V head repeated for the query heads sharing it
+    state_dict = gqa.state_dict()
+    for i in range(gqa.config.n_layer):
+        name = f"transformer.h.{i}.attn.c_attn.weight"
+        q, k, v = state_dict[name].split([32, 16, 16])
+        k, v = (t.view(2, 1, 8, 32).expand(2, 2, 8, 32).reshape(32, 32) for t in (k, v))
+        state_dict[name] = torch.cat([q, k, v])
+    mha.load_state_dict(state_dict)
+    x = torch.randint(100, (2, 7))
+
+    gqa.setup_caches(max_batch_size=2, max_seq_length=8)
+    mha.setup_caches(max_batch_size=2, max_seq_length=8)
+
+    torch.testing.assert_close(gqa(x, torch.arange(7)), mha(x, torch.arange(7)))
@@ -0,0 +1,34 @@
+import pytest
+import torch
+from conftest import greedy_reference, tiny_config
+
+from generate import generate
+from model import LLaMA
+from offload import LayerStreamer
+from utils import mmap_load, save_mmap_checkpoint
+
+
+@pytest.mark.parametrize("max_resident_layers", [1, 2])
+def test_streamed_blocks_match_reference(tiny_model, tmp_path, max_resident_layers):
+    save_mmap_checkpoint(tiny_model.state_dict(), tmp_path / "lit-llama.mmap")
+    checkpoint = mmap_load(tmp_path / "lit-llama.mmap")
+    with torch.device("meta"):
+        model = LLaMA(tiny_config())
+    resident = {k: t.clone() for k, t in checkpoint.sd.items() if not k.startswith("transformer.h.")}
+    model.load_state_dict(resident, strict=False, assign=True)
+    prompt = torch.randint(100, (6,), generator=torch.Generator().manual_seed(17), dtype=torch.int)
+
+    streamer = LayerStreamer(model.eval(), checkpoint, max_resident_layers)
+    y = generate(model, prompt, 5, top_k=1)
+    streamer.close()
+
+    torch.testing.assert_close(y, greedy_reference(tiny_model, prompt, 5))
+    stats = streamer.stats()
+    if max_resident_layers == 1:
+        # every block is read in again for each of the 5 forward passes and dropped after it
+        assert stats["hits"] + stats["misses"] == 2 * 5
+        assert all(block.attn.c_attn.weight.is_meta for block in model.transformer.h)
+    else:
+        # both blocks fit, they are read once and stay
+        assert stats["hits"] + stats["misses"] == 2
+        assert not any(block.attn.c_attn.weight.is_meta for block in model.transformer.h)
@@ -0,0 +1,48 @@
+import torch
+from conftest import greedy_reference
+
+from generate import generate_batch
+from prefix_cache import PrefixCache
+
+
+def test_prefix_cache_reuses_shared_prefix(tiny_model):
+    generator = torch.Generator().manual_seed(11)
+    prefix = torch.randint(100, (8,), generator=generator, dtype=torch.int)
+    prompts = [torch.cat([prefix, torch.randint(100, (n,), generator=generator, dtype=torch.int)]) for n in (3, 5)]
+    prefix_cache = PrefixCache(chunk_size=4)
+
+    first = generate_batch(tiny_model, prompts[:1], 6, max_seq_length=24, top_k=1, prefix_cache=prefix_cache)[0]
+    second = generate_batch(tiny_model, prompts[1:], 6, max_seq_length=24, top_k=1, prefix_cache=prefix_cache)[0]
+
+    # both full chunks of the shared prefix are restored for the second prompt
+    assert prefix_cache.hit_tokens == 8
+    torch.testing.assert_close(first, greedy_reference(tiny_model, prompts[0], 6))
+    torch.testing.assert_close(second, greedy_reference(tiny_model, prompts[1], 6))
+
+
+def test_prefix_cache_evicts_least_recently_used(tiny_model):
+    tokens = list(range(8))
+    tiny_model.setup_caches(max_batch_size=1, max_seq_length=16)
+    prefix_cache = PrefixCache(chunk_size=4, max_bytes=1)
+
+    with torch.no_grad():
+        prefix_cache.store(tiny_model, 0, tokens)
+
+    assert not prefix_cache.blocks and prefix_cache.nbytes == 0
+    assert prefix_cache.load(tiny_model, 0, tokens) == 0
+
+
+@torch.no_grad()
+def test_prefix_cache_evicts_extensions_first(tiny_model):
+    tiny_model.setup_caches(max_batch_size=1, max_seq_length=16)
+    prefix_cache = PrefixCache(chunk_size=4)
+    prefix_cache.store(tiny_model, 0, list(range(8)))
+    # room for the two chunks stored so far, not for a third
+    prefix_cache.max_bytes = prefix_cache.nbytes
+
+    prefix_cache.store(tiny_model, 0, list(range(50, 54)))
+
+    # the second chunk of the first prompt goes, its first chunk can still be restored
+    assert len(prefix_cache.blocks) == 2
+    assert all(block.parent is None or block.parent in prefix_cache.blocks for block in prefix_cache.blocks.values())
+    assert prefix_cache.load(tiny_model, 0, list(range(8))) == 4
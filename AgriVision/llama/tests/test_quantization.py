@@ -0,0 +1,51 @@
+import pytest
+import torch
+from conftest import tiny_config
+
+from model import LLaMA
+from quantize import convert, quantized_linear
+from utils import lazy_load, load_state_dict_parallel, quantization
+
+
+@pytest.mark.parametrize(("mode", "max_error"), [("int8", 0.02), ("gptq.int8", 0.02), ("gptq.int4", 0.15)])
+def test_quantized_linear_matches_float(mode, max_error):
+    torch.manual_seed(0)
+    weight = torch.randn(48, 256) / 16
+    x = torch.randn(3, 256)
+
+    layer = quantized_linear(weight, mode)
+    # more than one tile of output rows
+    layer.tile_rows = 32
+    expected = x @ weight.T
+
+    assert (layer(x) - expected).norm() / expected.norm() < max_error
+
+
+def test_unknown_quantization_mode():
+    with pytest.raises(ValueError, match="llm.int8"):
+        with quantization("llm.int8"):
+            pass
+
+
+@pytest.mark.parametrize(("mode", "max_error"), [("int8", 0.05), ("gptq.int4", 0.25)])
+def test_quantized_checkpoint_loads(tmp_path, mode, max_error):
+    torch.manual_seed(0)
+    # wide enough for 128-column int4 groups
+    config = tiny_config(n_embd=128)
+    model = LLaMA(config).eval()
+    torch.save(model.state_dict(), tmp_path / "lit-llama.pth")
+
+    convert(tmp_path / "lit-llama.pth", tmp_path / "quantized.pth", mode)
+    with quantization(mode):
+        quantized = LLaMA(config).eval()
+    # loaded like generate.load_model does, incremental_save output is not a weights_only pickle
+    with lazy_load(tmp_path / "quantized.pth") as checkpoint:
+        load_state_dict_parallel(quantized, checkpoint)
+
+    x = torch.randint(100, (1, 6))
+    with torch.no_grad():
+        model.setup_caches(max_batch_size=1, max_seq_length=8)
+        quantized.setup_caches(max_batch_size=1, max_seq_length=8)
+        expected = model(x, torch.arange(6))
+        logits = quantized(x, torch.arange(6))
+    assert (logits - expected).norm() / expected.norm() < max_error
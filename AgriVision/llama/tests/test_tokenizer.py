@@ -0,0 +1,60 @@
+import pytest
+from sentencepiece import SentencePieceTrainer
+
+from tokenizer import Tokenizer
+
+TEXT = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Crème brûlée and café au lait, naïvely ordered.",
+    "Rice, wheat and maize need water 🌾 and sunlight ☀️.",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory) -> Tokenizer:
+    prefix = tmp_path_factory.mktemp("tokenizer") / "tokenizer"
+    # byte fallback spells every character missing from the tiny vocabulary as its UTF-8 bytes
+    SentencePieceTrainer.train(
+        sentence_iterator=iter(TEXT * 20),
+        model_prefix=str(prefix),
+        vocab_size=400,
+        character_coverage=0.98,
+        byte_fallback=True,
+        hard_vocab_limit=False,
+    )
+    return Tokenizer(f"{prefix}.model")
+
+
+@pytest.mark.parametrize("text", TEXT)
+def test_incremental_decoder_matches_decode(tokenizer, text):
+    tokens = tokenizer.encode(text, bos=True, eos=True)
+    decoder = tokenizer.incremental_decoder(strip_leading_space=True)
+
+    streamed = "".join(decoder.add(token) for token in tokens.tolist()) + decoder.flush()
+
+    assert streamed == tokenizer.decode(tokens)
+
+
+def test_encode_batch_pads_and_caches(tokenizer):
+    tokenizer.cache.clear()
+
+    tokens, lengths = tokenizer.encode_batch(TEXT, bos=True, pad_value=-1)
+
+    for i, text in enumerate(TEXT):
+        expected = tokenizer.encode(text, bos=True)
+        assert lengths[i] == expected.size(0)
+        assert tokens[i, : lengths[i]].tolist() == expected.tolist()
+        assert (tokens[i, lengths[i] :] == -1).all()
+    assert list(tokenizer.cache) == TEXT
+    assert tokenizer.decode_batch(tokens, lengths) == [tokenizer.decode(tokens[i, : lengths[i]]) for i in range(len(TEXT))]
+
+
+def test_encode_cache_evicts_least_recently_used(tokenizer):
+    tokenizer.cache.clear()
+    tokenizer.cache_size = 2
+
+    for text in (TEXT[0], TEXT[1], TEXT[0], TEXT[2]):
+        tokenizer.encode(text)
+
+    assert list(tokenizer.cache) == [TEXT[0], TEXT[2]]
+    tokenizer.cache_size = 1024
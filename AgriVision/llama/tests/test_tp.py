@@ -0,0 +1,40 @@
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from conftest import greedy_reference, tiny_config
+
+from generate import generate
+from model import llama_configs
+from tp import load_tp_model
+
+
+def _generate_on_rank(rank, world_size, store, checkpoint_path, prompt, output_path):
+    dist.init_process_group("gloo", init_method=f"file://{store}", rank=rank, world_size=world_size)
+    # lets llama_model_lookup name the tiny checkpoint; ranks are spawned, so no other test sees the entry
+    config = tiny_config()
+    llama_configs["test"] = dict(
+        block_size=config.block_size,
+        vocab_size=config.vocab_size,
+        n_layer=config.n_layer,
+        n_head=config.n_head,
+        n_embd=config.n_embd,
+    )
+    # every rank reads only its own shard of the checkpoint through lazy_load
+    model = load_tp_model(checkpoint_path, rank, world_size, torch.float32)
+    y = generate(model, prompt, 8, top_k=1)
+    if rank == 0:
+        torch.save(y, output_path)
+    dist.destroy_process_group()
+
+
+def test_tp_generate_matches_reference(tiny_model, tmp_path):
+    prompt = torch.randint(100, (6,), generator=torch.Generator().manual_seed(7), dtype=torch.int)
+    torch.save(tiny_model.state_dict(), tmp_path / "lit-llama.pth")
+
+    mp.spawn(
+        _generate_on_rank,
+        args=(2, tmp_path / "store", tmp_path / "lit-llama.pth", prompt, tmp_path / "y.pt"),
+        nprocs=2,
+    )
+
+    torch.testing.assert_close(torch.load(tmp_path / "y.pt"), greedy_reference(tiny_model, prompt, 8))
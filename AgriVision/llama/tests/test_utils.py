@@ -0,0 +1,54 @@
+import torch
+from conftest import tiny_config
+
+from convert_mmap import convert
+from model import LLaMA
+from utils import (
+    MMAP_ALIGNMENT,
+    cpu_supports_bf16,
+    is_mmap_checkpoint,
+    lazy_load,
+    load_state_dict_parallel,
+    mmap_load,
+    pick_device,
+    pick_dtype,
+)
+
+
+def test_mmap_checkpoint_round_trip(tiny_model, tmp_path):
+    torch.save(tiny_model.state_dict(), tmp_path / "lit-llama.pth")
+
+    convert(tmp_path / "lit-llama.pth", tmp_path / "lit-llama.mmap", dtype="bfloat16")
+    assert is_mmap_checkpoint(tmp_path / "lit-llama.mmap")
+    assert not is_mmap_checkpoint(tmp_path / "lit-llama.pth")
+
+    checkpoint = mmap_load(tmp_path / "lit-llama.mmap")
+    for name, tensor in tiny_model.state_dict().items():
+        assert checkpoint.ranges[name][0] % MMAP_ALIGNMENT == 0
+        torch.testing.assert_close(checkpoint.sd[name], tensor.to(torch.bfloat16))
+    with torch.device("meta"):
+        model = LLaMA(tiny_config())
+    model.load_state_dict(checkpoint.sd, assign=True)
+    checkpoint.evict(list(checkpoint.sd))
+    # evicted pages are read back from the file
+    torch.testing.assert_close(model.lm_head.weight, tiny_model.lm_head.weight.to(torch.bfloat16))
+
+
+def test_load_state_dict_parallel(tiny_model, tmp_path):
+    torch.save(tiny_model.state_dict(), tmp_path / "lit-llama.pth")
+    model = LLaMA(tiny_config())
+
+    with lazy_load(tmp_path / "lit-llama.pth") as checkpoint:
+        timings = load_state_dict_parallel(model, checkpoint, num_workers=2, max_inflight_layers=1)
+
+    assert set(timings) == {"read", "convert", "copy", "total"}
+    for name, tensor in tiny_model.state_dict().items():
+        torch.testing.assert_close(model.state_dict()[name], tensor)
+
+
+def test_pick_device_and_dtype():
+    device = pick_device("cpu")
+
+    assert device == torch.device("cpu")
+    assert pick_dtype(device) == (torch.bfloat16 if cpu_supports_bf16() else torch.float32)
+    assert pick_device("auto").type in ("cpu", "cuda", "mps")
@@ -1,19 +1,41 @@
+import codecs
 import os
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Sequence, Tuple
 
 import torch
 from sentencepiece import SentencePieceProcessor, SentencePieceTrainer
 
 
 class Tokenizer:
-    """Tokenizer for LLaMA."""
+    """Tokenizer for LLaMA.
 
-    def __init__(self, model_path: Path) -> None:
+    Encodings of the last ``cache_size`` distinct strings are kept, so repeated prompts and templates are only run
+    through SentencePiece once.
+    """
+
+    def __init__(self, model_path: Path, cache_size: int = 1024) -> None:
         self.processor = SentencePieceProcessor(model_file=str(model_path))
         self.bos_id = self.processor.bos_id()
         self.eos_id = self.processor.eos_id()
         self.pad_id = self.processor.pad_id()
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, List[int]]" = OrderedDict()
+
+    def _encode_cached(self, strings: Sequence[str], num_threads: int = -1) -> List[List[int]]:
+        # one batched, multi-threaded SentencePiece call for every string not in the LRU cache
+        missing = list(dict.fromkeys(s for s in strings if s not in self.cache))
+        if missing:
+            for string, ids in zip(missing, self.processor.encode(missing, num_threads=num_threads)):
+                self.cache[string] = ids
+        result = []
+        for string in strings:
+            self.cache.move_to_end(string)
+            result.append(self.cache[string])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
 
     @property
     def vocab_size(self) -> int:
@@ -28,7 +50,7 @@ class Tokenizer:
         pad: bool = False,
         device: Optional[torch.device] = None
     ) -> torch.Tensor:
-        tokens = self.processor.encode(string)
+        tokens = list(self._encode_cached([string])[0])
         if bos:
             tokens = [self.bos_id] + tokens
         if eos:
@@ -43,7 +65,84 @@ class Tokenizer:
     def decode(self, tokens: torch.Tensor) -> str:
         return self.processor.decode(tokens.tolist())
 
+    def encode_batch(
+        self,
+        strings: Sequence[str],
+        bos: bool = True,
+        eos: bool = False,
+        pad_value: int = 0,
+        device: Optional[torch.device] = None,
+        num_threads: int = -1,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Encodes ``strings`` together, returning the right-padded ``[B, T]`` tokens and the ``[B]`` lengths.
+
+        Uncached strings go through SentencePiece in one call over ``num_threads`` threads (-1 uses all cores), and the
+        padded batch is built in a single tensor allocation, ready for ``generate_batch``-style prefill.
+        """
+        prefix = [self.bos_id] if bos else []
+        suffix = [self.eos_id] if eos else []
+        encoded = [prefix + ids + suffix for ids in self._encode_cached(strings, num_threads)]
+        T = max((len(ids) for ids in encoded), default=0)
+        padded = [ids + [pad_value] * (T - len(ids)) for ids in encoded]
+        tokens = torch.tensor(padded, dtype=torch.int, device=device).view(len(encoded), T)
+        lengths = torch.tensor([len(ids) for ids in encoded], dtype=torch.int, device=device)
+        return tokens, lengths
+
+    def decode_batch(
+        self, tokens: torch.Tensor, lengths: Optional[torch.Tensor] = None, num_threads: int = -1
+    ) -> List[str]:
+        """Decodes every row of ``[B, T]`` tokens, each cut to its length if ``lengths`` is given, in one
+        SentencePiece call."""
+        rows = tokens.tolist()
+        if lengths is not None:
+            rows = [row[:n] for row, n in zip(rows, lengths.tolist())]
+        return self.processor.decode(rows, num_threads=num_threads)
+
+    def incremental_decoder(self, strip_leading_space: bool = False) -> "IncrementalDecoder":
+        return IncrementalDecoder(self, strip_leading_space)
+
     @staticmethod
     def train(input: str, destination: str, vocab_size=32000) -> None:
         model_prefix = os.path.join(destination, "tokenizer")
         SentencePieceTrainer.Train(input=input, model_prefix=model_prefix, vocab_size=vocab_size)
+
+
+class IncrementalDecoder:
+    """Decodes a stream of token ids one token at a time, returning only the newly completed text.
+
+    Each token maps to its piece directly, so the cost per token is constant instead of re-decoding the whole
+    sequence. Byte-fallback pieces (``<0xE2>``) are fed through an incremental UTF-8 decoder that holds back a partial
+    multi-byte character until its last byte arrives.
+
+    Args:
+        tokenizer: The tokenizer whose ids are decoded.
+        strip_leading_space: Whether to drop the space that starts the first piece, as ``Tokenizer.decode`` does at the
+            start of a sequence. Leave it off when continuing text, such as a prompt.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, strip_leading_space: bool = False) -> None:
+        self.processor = tokenizer.processor
+        self.strip_leading_space = strip_leading_space
+        self.utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def add(self, token: int) -> str:
+        """Returns the text completed by ``token``, possibly empty."""
+        if self.processor.is_control(token):
+            return ""
+        if self.processor.is_byte(token):
+            # byte pieces are spelled "<0xAB>"
+            data = bytes([int(self.processor.id_to_piece(token)[3:5], 16)])
+        elif self.processor.is_unknown(token):
+            data = " \u2047 ".encode("utf-8")
+        else:
+            data = self.processor.id_to_piece(token).replace("\u2581", " ").encode("utf-8")
+        text = self.utf8.decode(data)
+        if self.strip_leading_space and text:
+            self.strip_leading_space = False
+            if text.startswith(" "):
+                text = text[1:]
+        return text
+
+    def flush(self) -> str:
+        """Returns whatever is left of an incomplete trailing character, as a replacement character."""
+        return self.utf8.decode(b"", final=True)
@@ -0,0 +1,185 @@
+"""Tensor-parallel LLaMA inference on CPUs, across processes talking over gloo.
+
+Every rank holds ``1 / world_size`` of the attention heads and of the MLP hidden units of every block:
+``c_attn``, ``c_fc1`` and ``c_fc2`` (or the fused ``c_fc``) are split by output features (columns of the matmul), the two ``c_proj`` by
+input features (rows), and the partial ``c_proj`` outputs are summed with one all-reduce per attention and per MLP.
+Embeddings, norms and ``lm_head`` are replicated, so all ranks compute the same logits and, seeded alike, sample the
+same tokens. Each rank reads only its own shard of the checkpoint.
+
+Launch one process per socket (or host)::
+
+    torchrun --nproc_per_node 2 tp.py --checkpoint_path checkpoints/lit-llama/30B/lit-llama.pth --numa true
+"""
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Mapping, Optional
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+# support running without installing as a package
+wd = Path(__file__).parent.parent.resolve()
+sys.path.append(str(wd))
+
+from generate import generate
+from model import LLaMA, LLaMAConfig
+from tokenizer import Tokenizer
+from utils import (
+    NotYetLoadedTensor,
+    configure_cpu_threads,
+    is_fused_mlp_checkpoint,
+    is_mmap_checkpoint,
+    lazy_load,
+    llama_model_lookup,
+    mmap_load,
+    pick_dtype,
+)
+
+
+def _all_reduce_hook(module: nn.Module, args, output: torch.Tensor) -> torch.Tensor:
+    dist.all_reduce(output)
+    return output
+
+
+def _resized_linear(linear: nn.Linear, in_features: int, out_features: int) -> nn.Linear:
+    return nn.Linear(in_features, out_features, bias=False, device=linear.weight.device, dtype=linear.weight.dtype)
+
+
+def apply_tp(model: LLaMA, world_size: int) -> LLaMA:
+    """Shrinks every block of ``model`` to one rank's share and sums the ``c_proj`` outputs across ranks.
+
+    Build the model on the meta device and call this before loading ``shard_state_dict`` into it.
+    """
+    config = model.config
+    assert config.n_kv_head % world_size == 0, f"{config.n_kv_head} K/V heads do not split over {world_size} ranks"
+    assert config.intermediate_size % world_size == 0, f"{config.intermediate_size} MLP units do not split over {world_size} ranks"
+    for block in model.transformer.h:
+        attn = block.attn
+        attn.n_head //= world_size
+        attn.n_kv_head //= world_size
+        attn.n_embd //= world_size
+        attn.kv_size //= world_size
+        attn.c_attn = _resized_linear(attn.c_attn, config.n_embd, attn.n_embd + 2 * attn.kv_size)
+        attn.c_proj = _resized_linear(attn.c_proj, attn.n_embd, config.n_embd)
+        attn.c_proj.register_forward_hook(_all_reduce_hook)
+
+        mlp = block.mlp
+        n_hidden = config.intermediate_size // world_size
+        if config.fused_mlp:
+            mlp.c_fc = _resized_linear(mlp.c_fc, config.n_embd, 2 * n_hidden)
+        else:
+            mlp.c_fc1 = _resized_linear(mlp.c_fc1, config.n_embd, n_hidden)
+            mlp.c_fc2 = _resized_linear(mlp.c_fc2, config.n_embd, n_hidden)
+        mlp.c_proj = _resized_linear(mlp.c_proj, n_hidden, config.n_embd)
+        mlp.c_proj.register_forward_hook(_all_reduce_hook)
+    return model
+
+
+def shard(name: str, tensor: torch.Tensor, config: LLaMAConfig, rank: int, world_size: int) -> torch.Tensor:
+    """The part of checkpoint tensor ``name`` that rank ``rank`` holds, a view where possible."""
+    if name.endswith("attn.c_attn.weight"):
+        # the fused projection stacks all Q rows, then K, then V: take this rank's heads of each
+        kv_size = config.n_kv_head * config.head_size
+        q, k, v = tensor.split([config.n_embd, kv_size, kv_size])
+        return torch.cat([q.chunk(world_size)[rank], k.chunk(world_size)[rank], v.chunk(world_size)[rank]])
+    if name.endswith("mlp.c_fc.weight"):
+        # likewise the fused MLP input projection stacks the gate rows, then the up rows
+        gate, up = tensor.chunk(2)
+        return torch.cat([gate.chunk(world_size)[rank], up.chunk(world_size)[rank]])
+    if name.endswith(("mlp.c_fc1.weight", "mlp.c_fc2.weight")):
+        return tensor.chunk(world_size, dim=0)[rank]
+    if name.endswith(("attn.c_proj.weight", "mlp.c_proj.weight")):
+        return tensor.chunk(world_size, dim=1)[rank]
+    return tensor
+
+
+def shard_state_dict(
+    checkpoint: Mapping, config: LLaMAConfig, rank: int, world_size: int, dtype: torch.dtype
+) -> Dict[str, torch.Tensor]:
+    """This rank's shards of a ``lazy_load`` or ``mmap_load`` checkpoint, cast to ``dtype``.
+
+    Tensors are materialized one at a time and only their shard is kept, so a rank never holds more than its share of
+    the model plus one full tensor.
+    """
+    state_dict = {}
+    for name, tensor in checkpoint.items():
+        if isinstance(tensor, NotYetLoadedTensor):
+            tensor = tensor._load_tensor()
+        if not tensor.dtype.is_floating_point:
+            raise ValueError(f"{name} is quantized, tensor parallelism needs a floating point checkpoint")
+        state_dict[name] = shard(name, tensor, config, rank, world_size).to(dtype=dtype, copy=True)
+    return state_dict
+
+
+def load_tp_model(checkpoint_path: Path, rank: int, world_size: int, dtype: torch.dtype) -> LLaMA:
+    load = mmap_load if is_mmap_checkpoint(checkpoint_path) else lazy_load
+    with load(checkpoint_path) as checkpoint:
+        name = llama_model_lookup(checkpoint)
+        with torch.device("meta"):
+            model = apply_tp(LLaMA.from_name(name, fused_mlp=is_fused_mlp_checkpoint(checkpoint)), world_size)
+        model.load_state_dict(shard_state_dict(checkpoint, model.config, rank, world_size, dtype), assign=True)
+    return model.eval()
+
+
+def main(
+    prompt: str = "Hello, my name is",
+    num_samples: int = 1,
+    max_new_tokens: int = 50,
+    top_k: int = 200,
+    temperature: float = 0.8,
+    checkpoint_path: Path = Path("checkpoints/lit-llama/30B/lit-llama.pth"),
+    tokenizer_path: Path = Path("checkpoints/lit-llama/tokenizer.model"),
+    dtype: Optional[str] = None,
+    num_threads: Optional[int] = None,
+    numa: bool = False,
+) -> None:
+    """Generates text with the model split over the ``torchrun`` processes. Rank 0 prints the results.
+
+    Args:
+        prompt: The prompt string to use for generating the samples.
+        num_samples: The number of text samples to generate.
+        max_new_tokens: The number of generation steps to take.
+        top_k: The number of top most probable tokens to consider in the sampling process.
+        temperature: A value controlling the randomness of the sampling process.
+        checkpoint_path: The full checkpoint, every rank reads its own shard of it.
+        tokenizer_path: The tokenizer path to load.
+        dtype: The weight dtype, bfloat16 or float32 depending on the CPU by default.
+        num_threads: The intra-op threads per rank. Defaults to the CPUs available to the rank.
+        numa: Whether to pin rank ``i`` to NUMA node ``i``, so every shard lives in the memory of the socket using it.
+    """
+    dist.init_process_group("gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    numa_node = rank if numa else None
+    if num_threads is None and not numa:
+        num_threads = max(1, torch.get_num_threads() // world_size)
+    configure_cpu_threads(num_threads, numa_node=numa_node)
+
+    dtype = pick_dtype(torch.device("cpu")) if dtype is None else getattr(torch, dtype)
+    t0 = time.perf_counter()
+    model = load_tp_model(checkpoint_path, rank, world_size, dtype)
+    dist.barrier()
+    if rank == 0:
+        print(f"Time to load model shards: {time.perf_counter() - t0:.02f} seconds.", file=sys.stderr)
+
+    tokenizer = Tokenizer(tokenizer_path)
+    encoded = tokenizer.encode(prompt, bos=True, eos=False)
+    # identical seeds keep the ranks sampling identical tokens
+    torch.manual_seed(1234)
+    for i in range(num_samples):
+        t0 = time.perf_counter()
+        y = generate(model, encoded, max_new_tokens, temperature=temperature, top_k=top_k)
+        t = time.perf_counter() - t0
+        model.reset_cache()
+        if rank == 0:
+            print(tokenizer.decode(y))
+            tokens_generated = y.size(0) - encoded.size(0)
+            print(f"Time for inference {i + 1}: {t:.02f} sec total, {tokens_generated / t:.02f} tokens/sec", file=sys.stderr)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    from jsonargparse import CLI
+
+    CLI(main)
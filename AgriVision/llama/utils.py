@@ -1,11 +1,21 @@
 """Utility functions for training and inference."""
 
 import functools
+import json
+import mmap
+import os
 import pickle
+import re
+import struct
+import threading
+import time
 import warnings
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
 from contextlib import contextmanager
+from typing import Dict, List, Mapping, Optional
 
 import torch
 import torch.utils._device
@@ -15,21 +25,28 @@ from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.distributed.fsdp import StateDictType
 from torch.serialization import normalize_storage_type
 
-llama_model_sizes = {
-    4096: "7B",  # 7B n_embd=4096
-    5120: "13B",  # 13B n_embd=5120
-    6656: "30B",  # 30B n_embd=6656
-    8192: "65B",  # 65B n_embd=8192
-}
-
+from model import LLaMAConfig, llama_configs
 
 def llama_model_lookup(checkpoint: dict) -> str:
     """Returns the LLaMA model name from the checkpoint.
-    
-    Checks the width of the lm_head.weight matrix, as these uniquely identify the model.
+
+    Matches the embedding shape, which gives the width and vocabulary, and the rows of the first fused QKV projection,
+    which give the number of K/V heads, against ``llama_configs``.
     """
-    embedding_size = checkpoint['transformer.wte.weight'].shape[1]
-    return llama_model_sizes[embedding_size]
+    vocab_size, embedding_size = checkpoint['transformer.wte.weight'].shape
+    qkv = checkpoint.get('transformer.h.0.attn.c_attn.weight', checkpoint.get('transformer.h.0.attn.c_attn.quant_weight'))
+    for name in llama_configs:
+        config = LLaMAConfig.from_name(name)
+        if (config.n_embd, config.padded_vocab_size) != (embedding_size, vocab_size):
+            continue
+        if qkv is None or qkv.shape[0] == config.n_embd + 2 * config.n_kv_head * config.head_size:
+            return name
+    raise ValueError(f"No LLaMA config with n_embd={embedding_size} and vocab size {vocab_size}")
+
+
+def is_fused_mlp_checkpoint(checkpoint: Mapping) -> bool:
+    """Whether the checkpoint stacks the MLP gate and up projections, as written by ``convert_inference.py``."""
+    return any(key.startswith("transformer.h.0.mlp.c_fc.") for key in checkpoint)
 
 
 def find_multiple(n: int, k: int) -> int:
@@ -38,6 +55,66 @@ def find_multiple(n: int, k: int) -> int:
     return n + k - (n % k)
 
 
+def pick_device(device: str = "auto") -> torch.device:
+    """Resolves ``"auto"`` to the best available of CUDA, MPS and CPU, any other value is used as given."""
+    if device != "auto":
+        return torch.device(device)
+    if torch.cuda.is_available():
+        return torch.device("cuda")
+    if torch.backends.mps.is_available():
+        return torch.device("mps")
+    return torch.device("cpu")
+
+
+def cpu_supports_bf16() -> bool:
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX), without which bf16 matmuls are emulated."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16"})
+
+
+def pick_dtype(device: torch.device) -> torch.dtype:
+    """The fastest inference dtype for ``device``: half precision on accelerators, bf16 on CPUs that support it."""
+    if device.type == "cuda":
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    if device.type == "mps":
+        return torch.float16
+    return torch.bfloat16 if cpu_supports_bf16() else torch.float32
+
+
+def numa_node_cpus(node: int) -> List[int]:
+    """The CPU ids of NUMA node ``node``, parsed from its sysfs ``cpulist`` such as ``"0-15,32-47"``."""
+    path = Path(f"/sys/devices/system/node/node{node}/cpulist")
+    if not path.is_file():
+        raise ValueError(f"NUMA node {node} does not exist")
+    cpus = []
+    for part in path.read_text().strip().split(","):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def configure_cpu_threads(
+    num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None, numa_node: Optional[int] = None
+) -> None:
+    """Sets up the CPU thread pools. Must run before any parallel torch work.
+
+    Args:
+        num_threads: The intra-op threads, defaulting to the number of CPUs available to the process.
+        num_interop_threads: The inter-op threads. Decoding runs one op at a time, so 1 avoids oversubscription.
+        numa_node: If specified, pin the process to this node's CPUs so threads only touch node-local memory.
+    """
+    if numa_node is not None:
+        os.sched_setaffinity(0, numa_node_cpus(numa_node))
+    if num_threads is None:
+        num_threads = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(num_interop_threads or 1)
+
+
 def save_model_checkpoint(fabric, model, file_path):
     """Handles boilerplate logic for retrieving and saving the state_dict.
     
@@ -76,26 +153,25 @@ class EmptyInitOnDevice(torch.overrides.TorchFunctionMode):
             device: `torch.device` to work with
             dtype: `torch.dtype` to work with
             quantization_mode: optional string, quantization mode to work with, default `None`.
-                 Available modes: `llm.int8` bitsnbytes LLM.int8 quantization (only on GPU)
-                                  `gptq.int4`, `gptq.int8`: GPTQ pre-quantized models
+                 Available modes: `int8`: weight-only per-channel int8, see `quantize.py`
+                                  `gptq.int4`, `gptq.int8`: group-wise quantized models, see `quantize.py`
 
         Example::
             with EmptyInitOnDevice("cuda", dtype=torch.bfloat16):
                model = LLaMA.from_name('7B')
-            model.load_state_dict(torch.load('llama-lit/7B/lit-llama.pth'))"""
+            with lazy_load('llama-lit/7B/lit-llama.pth') as checkpoint:
+               load_state_dict_parallel(model, checkpoint)"""
 
         self.quantization_mode = quantization_mode
         self.quantized_linear_cls = None
-        if self.quantization_mode == 'llm.int8':
-            if device.type != "cuda":
-                raise ValueError("Quantization is only supported on the GPU.")
-            from .quantization import Linear8bitLt
-            self.quantized_linear_cls = Linear8bitLt
+        if self.quantization_mode == 'int8':
+            from quantization import LinearInt8
+            self.quantized_linear_cls = LinearInt8
         elif self.quantization_mode == 'gptq.int4':
-            from .quantization import ColBlockQuantizedLinear
-            self.quantized_linear_cls = functools.partial(ColBlockQuantizedLinear, bits=4, tile_cols=-1)
+            from quantization import INT4_GROUP_SIZE, ColBlockQuantizedLinear
+            self.quantized_linear_cls = functools.partial(ColBlockQuantizedLinear, bits=4, tile_cols=INT4_GROUP_SIZE)
         elif self.quantization_mode == 'gptq.int8':
-            from .quantization import ColBlockQuantizedLinear
+            from quantization import ColBlockQuantizedLinear
             self.quantized_linear_cls = functools.partial(ColBlockQuantizedLinear, bits=8, tile_cols=-1)
         elif self.quantization_mode is not None:
             raise RuntimeError(f"unknown quantization mode {self.quantization_mode}")
@@ -138,14 +214,14 @@ class EmptyInitOnDevice(torch.overrides.TorchFunctionMode):
 @contextmanager
 def quantization(mode: str = None):
     quantized_linear_cls = None
-    if mode == 'llm.int8':
-        from .quantization import Linear8bitLt
-        quantized_linear_cls = Linear8bitLt
+    if mode == 'int8':
+        from quantization import LinearInt8
+        quantized_linear_cls = LinearInt8
     elif mode == 'gptq.int4':
-        from .quantization import ColBlockQuantizedLinear
-        quantized_linear_cls = functools.partial(ColBlockQuantizedLinear, bits=4, tile_cols=-1)
+        from quantization import INT4_GROUP_SIZE, ColBlockQuantizedLinear
+        quantized_linear_cls = functools.partial(ColBlockQuantizedLinear, bits=4, tile_cols=INT4_GROUP_SIZE)
     elif mode == 'gptq.int8':
-        from .quantization import ColBlockQuantizedLinear
+        from quantization import ColBlockQuantizedLinear
         quantized_linear_cls = functools.partial(ColBlockQuantizedLinear, bits=8, tile_cols=-1)
     elif mode is not None:
         raise ValueError(f"Unknown quantization mode: {mode}")
@@ -341,6 +417,72 @@ class lazy_load:
         self.zf = None
 
 
+def _layer_groups(names) -> List[List[str]]:
+    """Groups state dict keys by transformer block, every other key in a group of its own, in checkpoint order."""
+    groups: Dict[str, List[str]] = {}
+    for name in names:
+        match = re.match(r"(transformer\.h\.\d+\.)", name)
+        groups.setdefault(match.group(1) if match else name, []).append(name)
+    return list(groups.values())
+
+
+@torch.no_grad()
+def load_state_dict_parallel(
+    model: torch.nn.Module, checkpoint: Mapping, num_workers: int = 4, max_inflight_layers: Optional[int] = None
+) -> Dict[str, float]:
+    """Copies ``checkpoint`` into the already allocated parameters and buffers of ``model``.
+
+    Unlike ``model.load_state_dict``, transformer blocks are read by a pool of ``num_workers`` threads. Each tensor is
+    cast to the dtype of its destination on the host and copied straight to the destination's device, and at most
+    ``max_inflight_layers`` blocks (default ``num_workers``) are held in host memory at a time.
+
+    Returns the seconds spent per phase: ``"read"``, ``"convert"`` and ``"copy"`` summed over the workers, and the
+    ``"total"`` wall time.
+    """
+    targets = model.state_dict(keep_vars=True)
+    missing = targets.keys() - checkpoint.keys()
+    unexpected = checkpoint.keys() - targets.keys()
+    if missing or unexpected:
+        raise RuntimeError(f"Error loading state dict: missing keys {sorted(missing)}, unexpected keys {sorted(unexpected)}")
+
+    timings: Dict[str, float] = defaultdict(float)
+    lock = threading.Lock()
+
+    # grad mode is thread-local, the decorator does not reach the workers
+    @torch.no_grad()
+    def load_group(names: List[str]) -> None:
+        elapsed = defaultdict(float)
+        for name in names:
+            target = targets[name]
+            t0 = time.perf_counter()
+            tensor = checkpoint[name]
+            if isinstance(tensor, NotYetLoadedTensor):
+                tensor = tensor._load_tensor()
+            t1 = time.perf_counter()
+            tensor = tensor.to(dtype=target.dtype)
+            t2 = time.perf_counter()
+            target.copy_(tensor)
+            elapsed["read"] += t1 - t0
+            elapsed["convert"] += t2 - t1
+            elapsed["copy"] += time.perf_counter() - t2
+        with lock:
+            for phase, seconds in elapsed.items():
+                timings[phase] += seconds
+
+    t0 = time.perf_counter()
+    max_inflight_layers = max_inflight_layers or num_workers
+    with ThreadPoolExecutor(num_workers) as executor:
+        inflight = []
+        for names in _layer_groups(checkpoint.keys()):
+            if len(inflight) >= max_inflight_layers:
+                inflight.pop(0).result()
+            inflight.append(executor.submit(load_group, names))
+        for future in inflight:
+            future.result()
+    timings["total"] = time.perf_counter() - t0
+    return dict(timings)
+
+
 class SavingProxyForStorage:
     def __init__(self, obj, saver, protocol_version=5):
         self.protocol_version = protocol_version
@@ -494,3 +636,94 @@ class incremental_save:
 
     def __exit__(self, type, value, traceback):
         self.zipfile.write_end_of_file()
+
+
+# flat checkpoint format for zero-copy loading:
+#   magic | u64 header length | JSON header | padding to a page | tensor data
+# the header maps each name to its dtype, shape and byte offset from the (page aligned) start of the data; every tensor
+# starts on a MMAP_ALIGNMENT boundary so it can be viewed in place with its own dtype
+
+MMAP_MAGIC = b"LLAMMAP1"
+MMAP_ALIGNMENT = 64
+MMAP_PAGE_SIZE = 4096
+
+
+def is_mmap_checkpoint(fn) -> bool:
+    with open(fn, "rb") as f:
+        return f.read(len(MMAP_MAGIC)) == MMAP_MAGIC
+
+
+def save_mmap_checkpoint(state_dict: Mapping, fn, dtype: Optional[torch.dtype] = None) -> None:
+    """Writes ``state_dict`` in the flat mmap format, one tensor at a time.
+
+    Values may be ``NotYetLoadedTensor``s from ``lazy_load`` (or anything else with a ``shape``, a ``dtype`` and a
+    ``_load_tensor``), which are only materialized while being written.
+    If ``dtype`` is given, floating point tensors are cast to it.
+    """
+    tensors = {}
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor_dtype = dtype if dtype is not None and tensor.dtype.is_floating_point else tensor.dtype
+        nbytes = torch.Size(tensor.shape).numel() * torch._utils._element_size(tensor_dtype)
+        tensors[name] = dict(dtype=str(tensor_dtype).split(".")[1], shape=list(tensor.shape), offset=offset, nbytes=nbytes)
+        offset = find_multiple(offset + nbytes, MMAP_ALIGNMENT)
+    header = json.dumps(dict(tensors=tensors)).encode("utf-8")
+    data_start = find_multiple(len(MMAP_MAGIC) + 8 + len(header), MMAP_PAGE_SIZE)
+
+    with open(fn, "wb") as f:
+        f.write(MMAP_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, tensor in state_dict.items():
+            if hasattr(tensor, "_load_tensor"):
+                tensor = tensor._load_tensor()
+            tensor = tensor.detach().to(device="cpu", dtype=getattr(torch, tensors[name]["dtype"])).contiguous()
+            f.seek(data_start + tensors[name]["offset"])
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+        # pad the tail so the last tensor's aligned end lies inside the file
+        f.truncate(data_start + offset)
+
+
+class mmap_load:
+    """Maps a checkpoint written by ``save_mmap_checkpoint``.
+
+    The tensors are views of one private (copy-on-write) file mapping, so loading them copies nothing and processes
+    mapping the same file share a single page cache copy.
+    """
+
+    def __init__(self, fn):
+        with open(fn, "rb") as f:
+            if f.read(len(MMAP_MAGIC)) != MMAP_MAGIC:
+                raise ValueError(f"{fn} is not an mmap checkpoint")
+            (header_len,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        data_start = find_multiple(len(MMAP_MAGIC) + 8 + header_len, MMAP_PAGE_SIZE)
+        data = torch.frombuffer(self.mm, dtype=torch.uint8)
+
+        self.sd = {}
+        # byte range of every tensor in the file
+        self.ranges = {}
+        for name, info in header["tensors"].items():
+            start = data_start + info["offset"]
+            tensor = data[start : start + info["nbytes"]].view(getattr(torch, info["dtype"]))
+            self.sd[name] = tensor.view(info["shape"])
+            self.ranges[name] = (start, start + info["nbytes"])
+
+    def evict(self, names) -> None:
+        """Drops the pages backing tensors ``names`` from this process' resident memory. They are read back from disk
+        if the tensors are touched again."""
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        for name in names:
+            start, end = self.ranges[name]
+            start -= start % mmap.PAGESIZE
+            if end > start:
+                self.mm.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def __enter__(self):
+        return self.sd
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the mapping must outlive the tensors viewing it, it is released once they are garbage collected
+        self.sd = None